@@ -0,0 +1,56 @@
+import conversion
+
+import argparse
+import sys
+import time
+
+resource_definition = {'Entity Name': 'Benchmark', 'ResourceType': 'Condition', 'Profile(s)': []}
+entity_definition = {'valueType': 'string', 'valuesets': None}
+
+#Paths a template could contain, and whether the path builder is expected to refuse them
+def benchmark_paths():
+    return [
+        ('simple path', 'Condition.code.text', False),
+        ('indexed path', 'Condition.code.coding[0].display', False),
+        ('nested indexes', 'Condition.note[0].extension[0].valueString', False),
+        ('qualifier condition', 'Condition.note[authorString=Dr Example].text', False),
+        ('path at the depth limit', 'Condition.' + '.'.join(['a'] * (conversion.max_path_depth - 1)), False),
+        ('index at the limit', f'Condition.code.coding[{conversion.max_list_index}].code', False),
+        ('index far over the limit', 'Condition.code.coding[100000000].code', True),
+        ('standalone index far over the limit', 'Condition.code.coding.[100000000].code', True),
+        ('path far over the depth limit', 'Condition.' + '.'.join(['a'] * 100000), True),
+    ]
+
+#Time building one path into a fresh resource; the mean of repeat builds in microseconds, or the error raised
+def time_path(json_path, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        try:
+            conversion.create_structure_from_jsonpath({'resourceType': 'Condition'}, json_path, resource_definition, entity_definition, 'string', 'value')
+        except (TypeError, ValueError) as e:
+            return (time.perf_counter() - start) * 1e6, e
+    return (time.perf_counter() - start) * 1e6 / repeat, None
+
+def main(repeat, budget_ms):
+    failures = []
+    print(f"Path builder (max path depth {conversion.max_path_depth}, max list index {conversion.max_list_index}):")
+    for label, json_path, should_fail in benchmark_paths():
+        elapsed_us, error = time_path(json_path, repeat)
+        outcome = f"refused: {str(error).split(' - ')[-1]}" if error else "built"
+        print(f"    {elapsed_us:10.1f}us  {label:<38} {outcome}")
+        if should_fail and error is None:
+            failures.append(f"{label} was built instead of being refused")
+        if not should_fail and error is not None:
+            failures.append(f"{label} was refused: {error}")
+        if elapsed_us > budget_ms * 1000:
+            failures.append(f"{label} took {elapsed_us / 1000:.1f}ms which is over the budget of {budget_ms}ms")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail if a pathological jsonpath can stall the path builder.")
+    parser.add_argument('--repeat', type=int, help="Number of builds to average per path", default=200)
+    parser.add_argument('--budget_ms', type=float, help="Maximum allowed time in milliseconds to build, or refuse, a single path", default=10)
+    args = parser.parse_args()
+    sys.exit(main(args.repeat, args.budget_ms))
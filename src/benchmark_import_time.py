@@ -0,0 +1,52 @@
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+#Modules that must never be loaded just by importing the CLI. They are only pulled in once a workbook is read.
+deferred_modules = ['openpyxl', 'jsonpath_ng', 'ply']
+
+#Import the target module in a fresh interpreter with `-X importtime` and collect the per module timings (microseconds)
+def measure_import_time(module_name):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module_name}"],
+                            cwd=Path(__file__).resolve().parent, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ERROR: - Import Time Benchmark - {module_name} - failed to import:\n{result.stderr}")
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+def main(module_name, budget_ms, repeat):
+    best_cumulative_us = None
+    for _ in range(repeat):
+        timings = measure_import_time(module_name)
+        cumulative_us = timings[module_name][1]
+        if best_cumulative_us is None or cumulative_us < best_cumulative_us:
+            best_cumulative_us = cumulative_us
+            best_timings = timings
+    failures = []
+    leaked = {name.split('.')[0] for name in best_timings if name.split('.')[0] in deferred_modules}
+    if leaked:
+        failures.append(f"deferred modules imported eagerly: {', '.join(sorted(leaked))}")
+    if best_cumulative_us > budget_ms * 1000:
+        failures.append(f"import took {best_cumulative_us / 1000:.1f}ms which is over the budget of {budget_ms}ms")
+
+    print(f"Import of '{module_name}' took {best_cumulative_us / 1000:.1f}ms (best of {repeat}, budget {budget_ms}ms)")
+    print("Slowest imports (cumulative):")
+    for name, (self_us, cumulative_us) in sorted(best_timings.items(), key=lambda item: item[1][1], reverse=True)[:10]:
+        print(f"    {cumulative_us / 1000:8.1f}ms  {name}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail if the startup import cost of the CLI regresses.")
+    parser.add_argument('--module', type=str, help="Module to import", default="fhirsheets")
+    parser.add_argument('--budget_ms', type=float, help="Maximum allowed cumulative import time in milliseconds", default=80)
+    parser.add_argument('--repeat', type=int, help="Number of fresh interpreters to sample; the best run is compared against the budget", default=5)
+    args = parser.parse_args()
+    sys.exit(main(args.module, args.budget_ms, args.repeat))
@@ -0,0 +1,96 @@
+import heapq
+import queue
+import threading
+
+# Build items ahead of a consumer. Items are (patient index, bundle) pairs produced in patient index order, and they
+# come out in the same order whichever way they were built.
+
+#Run the items generator on a background thread, keeping up to prefetch items ready. Python code holds the GIL, so this
+#only helps while the consumer waits on I/O (a network sink, a database); use in_processes to build on several cores
+def in_thread(items, prefetch):
+    output_queue = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+
+    #Put unless the consumer has stopped, so the thread never blocks on a queue nobody reads
+    def put(item):
+        while not stop.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+        finally:
+            items.close()
+
+    thread = threading.Thread(target=produce, name="bundle-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = output_queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+#Split the work over worker processes: worker k runs produce(*args, shard=(k, processes)), which yields the items of
+#every patient index i with i % processes == k - 1. Each worker keeps up to prefetch items ready and the streams are
+#merged back into patient index order. produce has to be a module level function so it can be sent to the workers
+def in_processes(produce, args, processes, prefetch):
+    import multiprocessing
+    workers = []
+    for k in range(1, processes + 1):
+        output_queue = multiprocessing.Queue(maxsize=max(prefetch, 1))
+        process = multiprocessing.Process(target=run_worker, args=(produce, args, (k, processes), output_queue),
+                                          name=f"bundle-worker-{k}", daemon=True)
+        process.start()
+        workers.append((process, output_queue))
+    try:
+        yield from heapq.merge(*(read_worker(process, output_queue) for process, output_queue in workers), key=lambda item: item[0])
+    finally:
+        for process, output_queue in workers:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            output_queue.close()
+
+#Worker process: send every item, then None. A failure is sent as (None, traceback) as exceptions may not pickle
+def run_worker(produce, args, shard, output_queue):
+    try:
+        for item in produce(*args, shard=shard):
+            output_queue.put(item)
+        output_queue.put(None)
+    except Exception:
+        import traceback
+        output_queue.put((None, traceback.format_exc()))
+
+def read_worker(process, output_queue):
+    while True:
+        try:
+            item = output_queue.get(timeout=1)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+            #Whatever a worker sent is flushed before it exits, so one more wait tells a crash from a slow pipe
+            try:
+                item = output_queue.get(timeout=1)
+            except queue.Empty:
+                raise RuntimeError(f"ERROR: - Bundle Prefetch - {process.name} exited with code {process.exitcode} before sending every bundle")
+        if item is None:
+            return
+        if item[0] is None:
+            raise RuntimeError(f"ERROR: - Bundle Prefetch - {process.name} failed:\n{item[1]}")
+        yield item
@@ -0,0 +1,168 @@
+import conversion
+import serialization
+
+# Packs the entries of patient transaction bundles into transactions that stay under a maximum number of entries
+# and a maximum size in bytes (compact json). Patients small enough are coalesced into a shared transaction; a
+# patient too large for one transaction is split, with referenced resources placed before the resources referencing
+# them, and any urn:uuid reference leaving its transaction re-targeted to the ResourceType/id the entry is PUT to.
+class TransactionBundlePacker:
+    def __init__(self, max_entries = None, max_bytes = None):
+        if max_entries is not None and max_entries < 1:
+            raise ValueError(f"ERROR: - Bundling - max entries must be at least 1, got {max_entries}")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        #Size of an empty transaction bundle, which every entry is added to
+        self.envelope_bytes = len(serialization.encode(conversion.initialize_bundle()))
+        if max_bytes is not None and max_bytes <= self.envelope_bytes:
+            raise ValueError(f"ERROR: - Bundling - max bytes must be larger than an empty bundle ({self.envelope_bytes} bytes), got {max_bytes}")
+        #(entries, bytes) of every bundle emitted
+        self.bundle_sizes = []
+
+    #Take an iterable of patient entry lists and lazily yield packed transaction bundles
+    def pack(self, patient_entries):
+        current_entries = []
+        current_bytes = self.envelope_bytes
+        for entries in patient_entries:
+            entry_sizes = [len(serialization.encode(entry)) for entry in entries]
+            patient_bytes = sum(entry_sizes) + len(entries)
+            #The patient fits alongside the patients already packed
+            if self.fits(len(current_entries) + len(entries), current_bytes + patient_bytes):
+                current_entries.extend(entries)
+                current_bytes += patient_bytes
+                continue
+            if current_entries:
+                yield self.emit(current_entries, current_bytes)
+                current_entries = []
+                current_bytes = self.envelope_bytes
+            #The patient fits in a transaction of its own; keep it open for the next patients
+            if self.fits(len(entries), self.envelope_bytes + patient_bytes):
+                current_entries = list(entries)
+                current_bytes += patient_bytes
+                continue
+            #The patient has to be split over several transactions
+            for chunk_entries, chunk_bytes in self.split_patient(entries, entry_sizes):
+                yield self.emit(chunk_entries, chunk_bytes)
+        if current_entries:
+            yield self.emit(current_entries, current_bytes)
+
+    def fits(self, entry_count, byte_count):
+        if self.max_entries is not None and entry_count > self.max_entries:
+            return False
+        if self.max_bytes is not None and byte_count > self.max_bytes:
+            return False
+        return True
+
+    def emit(self, entries, byte_count):
+        bundle = conversion.initialize_bundle()
+        bundle['entry'] = entries
+        #Separators between entries were counted per entry; the first one is not written
+        byte_count = byte_count - 1 if entries else byte_count
+        self.bundle_sizes.append((len(entries), byte_count))
+        return bundle
+
+    def split_patient(self, entries, entry_sizes):
+        sizes_by_entry = {id(entry): size for entry, size in zip(entries, entry_sizes)}
+        chunks = []
+        chunk = []
+        chunk_bytes = self.envelope_bytes
+        for entry in order_by_references(entries):
+            entry_bytes = sizes_by_entry[id(entry)] + 1
+            if chunk and not self.fits(len(chunk) + 1, chunk_bytes + entry_bytes):
+                chunks.append(chunk)
+                chunk = []
+                chunk_bytes = self.envelope_bytes
+            if not chunk and not self.fits(1, chunk_bytes + entry_bytes):
+                resource = entry.get('resource', {})
+                print(f"WARNING: - Bundling - {resource.get('resourceType')}/{resource.get('id')} - entry of {entry_bytes - 1} bytes is larger than the maximum bundle size of {self.max_bytes} bytes on its own")
+            chunk.append(entry)
+            chunk_bytes += entry_bytes
+        if chunk:
+            chunks.append(chunk)
+        for chunk in chunks:
+            retarget_external_references(chunk, entries)
+            #Re-targeting changes the size of a reference; measure the chunk as it will be written
+            yield chunk, self.envelope_bytes + sum(len(serialization.encode(entry)) + 1 for entry in chunk)
+
+    #Summary of the size distribution of every bundle emitted so far
+    def report(self):
+        if not self.bundle_sizes:
+            return "Bundling: no bundles written"
+        entry_counts = sorted(entries for entries, _ in self.bundle_sizes)
+        byte_counts = sorted(byte_count for _, byte_count in self.bundle_sizes)
+        lines = [f"Bundling: {len(self.bundle_sizes)} bundles (max entries: {self.max_entries}, max bytes: {self.max_bytes})"]
+        for label, values in (('entries', entry_counts), ('bytes', byte_counts)):
+            lines.append(f"    {label:<8} min {values[0]}  median {percentile(values, 50)}  p90 {percentile(values, 90)}  max {values[-1]}  total {sum(values)}")
+        return "\n".join(lines)
+
+def percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, (len(sorted_values) * percent) // 100)
+    return sorted_values[index]
+
+#Collect every reference string within a resource
+def find_references(d, found):
+    if isinstance(d, dict):
+        for key, value in d.items():
+            if key == 'reference' and isinstance(value, str):
+                found.append(value)
+            else:
+                find_references(value, found)
+    elif isinstance(d, list):
+        for item in d:
+            find_references(item, found)
+    return found
+
+#Every way an entry can be referenced: its fullUrl and the ResourceType/id it is PUT to
+def entry_reference_keys(entry):
+    keys = []
+    if entry.get('fullUrl'):
+        keys.append(entry['fullUrl'])
+    if entry.get('request', {}).get('url'):
+        keys.append(entry['request']['url'])
+    return keys
+
+#Order entries so a referenced entry comes before the entries referencing it; cycles keep their original order
+def order_by_references(entries):
+    entries_by_key = {}
+    for entry in entries:
+        for key in entry_reference_keys(entry):
+            entries_by_key[key] = entry
+    ordered = []
+    visited = set()
+    for entry in entries:
+        if id(entry) in visited:
+            continue
+        visited.add(id(entry))
+        stack = [(entry, iter(find_references(entry.get('resource'), [])))]
+        while stack:
+            current, references = stack[-1]
+            for reference in references:
+                target = entries_by_key.get(reference)
+                if target is not None and id(target) not in visited:
+                    visited.add(id(target))
+                    stack.append((target, iter(find_references(target.get('resource'), []))))
+                    break
+            else:
+                stack.pop()
+                ordered.append(current)
+    return ordered
+
+#urn:uuid references only resolve inside their own transaction; point references to entries in another transaction
+#at the ResourceType/id that entry is PUT to instead
+def retarget_external_references(chunk, entries):
+    in_chunk = {entry['fullUrl'] for entry in chunk if entry.get('fullUrl')}
+    request_urls = {entry['fullUrl']: entry['request']['url'] for entry in entries
+                    if entry.get('fullUrl') and entry.get('request', {}).get('url')}
+    for entry in chunk:
+        retarget_references(entry.get('resource'), in_chunk, request_urls)
+
+def retarget_references(d, in_chunk, request_urls):
+    if isinstance(d, dict):
+        for key, value in d.items():
+            if key == 'reference' and isinstance(value, str):
+                if value not in in_chunk and value in request_urls:
+                    d[key] = request_urls[value]
+            else:
+                retarget_references(value, in_chunk, request_urls)
+    elif isinstance(d, list):
+        for item in d:
+            retarget_references(item, in_chunk, request_urls)
@@ -0,0 +1,100 @@
+import io
+import threading
+from pathlib import Path
+
+#First bytes of a gzip member and of a zstd frame
+gzip_magic = b'\x1f\x8b'
+zstd_magic = b'\x28\xb5\x2f\xfd'
+
+# A compression format for output files. compress() turns bytes into one complete gzip member or zstd frame; members and
+# frames concatenate into a valid stream, so chunks of one file can be compressed independently on several threads.
+# compress() is safe to call from several threads at once.
+class Codec:
+    def __init__(self, name, suffix, compress):
+        self.name = name
+        self.suffix = suffix
+        self.compress = compress
+
+#The codec called name ('gzip' or 'zstd'), at the default level of the format when level is None
+def get_codec(name, level = None):
+    if name == 'gzip':
+        return Codec('gzip', '.gz', gzip_compressor(6 if level is None else level))
+    if name == 'zstd':
+        return Codec('zstd', '.zst', zstd_compressor(3 if level is None else level))
+    raise ValueError(f"ERROR: - Compression - unknown compression '{name}', expected gzip or zstd")
+
+def gzip_compressor(level):
+    import gzip
+    #A fixed mtime keeps the output identical between runs
+    return lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+
+def zstd_compressor(level):
+    stdlib_zstd, zstandard = import_zstd()
+    if stdlib_zstd is not None:
+        return lambda data: stdlib_zstd.compress(data, level=level)
+    #zstandard compressor objects can not be shared between threads, so every thread keeps its own
+    local = threading.local()
+    def compress(data):
+        if not hasattr(local, 'compressor'):
+            local.compressor = zstandard.ZstdCompressor(level=level)
+        return local.compressor.compress(data)
+    return compress
+
+#zstd is in the standard library from Python 3.14 (compression.zstd); older versions need the zstandard package.
+#Returns (compression.zstd, None) or (None, zstandard)
+def import_zstd():
+    try:
+        from compression import zstd
+        return zstd, None
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return None, zstandard
+    except ImportError:
+        raise ValueError("ERROR: - Compression - zstd needs Python 3.14 or the zstandard package (pip install zstandard)")
+
+#Whether the codec called name can be used in this environment; gzip always can
+def codec_available(name):
+    if name == 'zstd':
+        try:
+            import_zstd()
+        except ValueError:
+            return False
+    return True
+
+#'gzip', 'zstd' or None, from the first bytes of the file rather than its name
+def detect_codec(path):
+    with open(path, 'rb') as input_file:
+        magic = input_file.read(4)
+    if magic.startswith(gzip_magic):
+        return 'gzip'
+    if magic == zstd_magic:
+        return 'zstd'
+    return None
+
+#Open a file for reading bytes, decompressing it when it is gzip or zstd compressed. Every member or frame is read in turn
+def open_input(path):
+    codec = detect_codec(path)
+    if codec == 'gzip':
+        import gzip
+        return gzip.open(path, 'rb')
+    if codec == 'zstd':
+        stdlib_zstd, zstandard = import_zstd()
+        if stdlib_zstd is not None:
+            return stdlib_zstd.open(path, 'rb')
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+        #The decompression reader has no readline, so line by line reading goes through a buffer
+        return io.BufferedReader(reader)
+    return open(path, 'rb')
+
+def read_bytes(path):
+    with open_input(path) as input_file:
+        return input_file.read()
+
+#Suffix of a file name once a compression suffix is dropped: '.ndjson' for 'bundles.ndjson.gz'
+def uncompressed_suffix(path):
+    suffixes = [suffix.lower() for suffix in Path(path).suffixes]
+    if suffixes and suffixes[-1] in ('.gz', '.zst'):
+        suffixes.pop()
+    return suffixes[-1] if suffixes else ''
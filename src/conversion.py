@@ -1,26 +1,48 @@
 import uuid
-from jsonpath_ng.jsonpath import Fields, Slice, Where
-from jsonpath_ng.ext import parse as parse_ext
 import fhir_formatting
 import special_values
 
+#Limits on the jsonpaths of the PatientData sheet, so a bad template fails with a clear error instead of stalling a run.
+#A path may have at most max_path_depth dot separated parts, and an index qualifier such as coding[3] at most max_list_index
+max_path_depth = 64
+max_list_index = 1000
+
 #Main top level function
-#Creates a full transaction bundle for a patient at index
-def create_transaction_bundle(resource_definition_entities, resource_link_entities, patient_data, index = 0):
+#Creates a full transaction bundle for a patient at index. row_fields is the entry of read_input's 'row_fields' for that
+#index; it saves checking every field of every entity for an empty cell, and the bundle is the same with or without it.
+#With prune_empty, resources the row has no data for are left out of the bundle, see create_bundle_resources
+def create_transaction_bundle(resource_definition_entities, resource_link_entities, patient_data, index = 0, row_fields = None, prune_empty = False):
     root_bundle = initialize_bundle()
+    created_resources = create_bundle_resources(resource_definition_entities, resource_link_entities, patient_data, index, row_fields, prune_empty)
+    #Construct into fhir bundle
+    for fhir_resource in created_resources.values():
+        add_resource_to_transaction_bundle(root_bundle, fhir_resource)
+    return root_bundle
+
+#Creates and links every resource for a patient at index, keyed by entity name, without wrapping them into a bundle.
+#With prune_empty, resources holding nothing but resourceType, id and meta are dropped before linking: links from or to
+#them are left out, and default links are worked out from the resources that remain
+def create_bundle_resources(resource_definition_entities, resource_link_entities, patient_data, index = 0, row_fields = None, prune_empty = False):
     created_resources = {}
+    pruned_entities = set()
     for resource_definition in resource_definition_entities:
         entity_name = resource_definition['Entity Name']
         #Create and collect fhir resources
-        fhir_resource = create_fhir_resource(resource_definition, patient_data, index)
+        fhir_resource = create_fhir_resource(resource_definition, patient_data, index, row_fields)
+        if prune_empty and is_empty_resource(fhir_resource):
+            pruned_entities.add(entity_name)
+            continue
         created_resources[entity_name] = fhir_resource
-    #Link resources after creation
-    add_default_resource_links(created_resources, resource_link_entities)
-    create_resource_links(created_resources, resource_link_entities)
-    #Construct into fhir bundle
-    for fhir_resource in created_resources.values():
-        add_resource_to_transaction_bundle(root_bundle, fhir_resource)
-    return root_bundle
+    #Link resources after creation. Default links are added to a per-bundle copy so the workbook's links stay untouched between patients
+    bundle_link_entities = [resource_link_entity for resource_link_entity in resource_link_entities
+                            if resource_link_entity['OriginResource'] not in pruned_entities and resource_link_entity['DestinationResource'] not in pruned_entities]
+    add_default_resource_links(created_resources, bundle_link_entities)
+    create_resource_links(created_resources, bundle_link_entities)
+    return created_resources
+
+#A resource with no field set from the row, only what initialize_resource gives every resource
+def is_empty_resource(fhir_resource):
+    return all(key in ('resourceType', 'id', 'meta') for key in fhir_resource)
 
 #Initialize root bundle definition
 def initialize_bundle():
@@ -32,7 +54,7 @@ def initialize_bundle():
     return root_bundle
 
 # Creates a fhir-json structure from a resource definition entity and the patient_data_sheet
-def create_fhir_resource(resource_definition, patient_data, index = 0):
+def create_fhir_resource(resource_definition, patient_data, index = 0, row_fields = None):
     resource_dict = initialize_resource(resource_definition)
     #Get field entries for this entitiy
     try:
@@ -40,8 +62,13 @@ def create_fhir_resource(resource_definition, patient_data, index = 0):
     except KeyError:
         print(f"WARNING: Patient index {index} - Create Fhir Resource Error - {resource_definition['Entity Name']} - No columns for entity '{resource_definition['Entity Name']}' found for resource in 'PatientData' sheet")
         return resource_dict
-    #For each field within the entity
-    for field_entry in all_field_entries.values():
+    #For each field within the entity with a value in this row, from the row's sparse index when it is given
+    if row_fields is not None:
+        field_entries = row_fields.get(resource_definition['Entity Name'], ())
+    else:
+        field_entries = [field_entry for field_entry in all_field_entries.values()
+                         if len(field_entry['values']) > index and field_entry['values'][index] is not None]
+    for field_entry in field_entries:
         #Create a jsonpath from each provided json path and value for this resource
         if field_entry['values'] and len(field_entry['values']) > index:
             create_structure_from_jsonpath(resource_dict, field_entry['jsonpath'], resource_definition, field_entry, field_entry['valueType'], field_entry['values'][index])
@@ -51,11 +78,10 @@ def create_fhir_resource(resource_definition, patient_data, index = 0):
 def initialize_resource(resource_definition):
     initial_resource = {}
     initial_resource['resourceType'] = resource_definition['ResourceType'].strip()
-    resource_definition['id'] = str(uuid.uuid4())
-    initial_resource['id'] = resource_definition['id'].strip()
+    initial_resource['id'] = str(uuid.uuid4())
     if resource_definition['Profile(s)']:
         initial_resource['meta'] = {
-            'profile': resource_definition['Profile(s)']
+            'profile': list(resource_definition['Profile(s)'])
         }
     return initial_resource
 
@@ -200,67 +226,67 @@ def create_structure_from_jsonpath(root_struct, json_path, resource_definition,
     parts = json_path.split('.')
     return build_structure(root_struct, json_path, resource_definition, entity_definition, parts, value, [])
 
-# main recursive function to drill into the json structure, assign paths, and create structure where needed
+# Walks the json structure one path part at a time, assigning the value at the last part and creating structure where needed.
+# previous_parts are the parts already walked by the caller, only used in error messages
 def build_structure(current_struct, json_path, resource_definition, entity_definition, parts, value, previous_parts):
     if len(parts) == 0:
         return current_struct
-    #Grab current part
-    part = parts[0]
-    #SPECIAL HANDLING CLAUSE 
+    #SPECIAL HANDLING CLAUSE; json_path is the same for every part, so a handler either takes the whole path or none of it
     matching_handler = next((handler for handler in special_values.custom_handlers if (json_path.startswith(handler) or json_path == handler)), None)
     if matching_handler is not None:
         return special_values.custom_handlers[matching_handler].assign_value(json_path, resource_definition, entity_definition, current_struct, parts[-1], value)
-    #Ignore dollar sign ($) and drill farther down
-    if part == '$' or part == resource_definition['ResourceType'].strip():
-        #Ignore the dollar sign and the resourcetype
-        return build_structure_recurse(current_struct, json_path, resource_definition, entity_definition, parts, value, previous_parts, part)
-    
-    # If parts length is one then this is the final key to access and pair
-    if len(parts) == 1:
-        #Check for numeic qualifier '[0]' and '[1]'
-        if '[' in part and ']' in part:
-        #Seperate the key from the qualifier
-            key_part = part[:part.index('[')]
-            qualifier = part[part.index('[')+1:part.index(']')]
-            qualifier_condition = qualifier.split('=')
-            
-            #If there is no key part, aka '[0]', '[1]' etc, then it's a simple accessor
-            if key_part is None or key_part == '':
-                if not qualifier.isdigit():
-                    raise TypeError(f"ERROR: Full jsonpath: {json_path} - current path - {'.'.join(previous_parts + parts[:1])} - qualifier - {qualifier} - standalone qualifier expected to be a single index numeric ([0], [1], etc)")
-                if current_struct == {}:
-                    current_struct = []
-                if not isinstance(current_struct, list):
-                    raise TypeError(f"ERROR: Full jsonpath: {json_path} - current path - {'.'.join(previous_parts + parts[:1])} - Expected a list, but got {type(current_struct).__name__} instead.")
-                part = int(qualifier)
-                if part + 1 > len(current_struct):
-                    current_struct.extend({} for x in range (part + 1 - len(current_struct)))
-        #Actual assigning to the path
-        fhir_formatting.assign_value(current_struct, part, value, entity_definition['valueType'])
-        return current_struct
-    
-    # If there is a simple qualifier with '['and ']'
-    elif '[' in part and ']' in part:
+    if len(parts) > max_path_depth:
+        shown_path = json_path if len(json_path) <= 200 else json_path[:200] + '...'
+        raise ValueError(f"ERROR: Full jsonpath: {shown_path} - path has {len(parts)} parts which is more than the maximum path depth of {max_path_depth}")
+    resource_type = resource_definition['ResourceType'].strip()
+    root_struct = current_struct
+    #Where current_struct is stored, so it can be replaced when an empty dict turns out to be a list
+    parent_struct, parent_key = None, None
+    last_position = len(parts) - 1
+    for position, part in enumerate(parts):
+        #Ignore the dollar sign and the resourcetype and drill farther down
+        if part == '$' or part == resource_type:
+            continue
+        if not ('[' in part and ']' in part):
+            #Non qualifier accessor; the last part is the final key to access and pair
+            if position == last_position:
+                fhir_formatting.assign_value(current_struct, part, value, entity_definition['valueType'], entity_definition.get('valuesets'))
+                break
+            if part not in current_struct:
+                current_struct[part] = {}
+            parent_struct, parent_key = current_struct, part
+            current_struct = current_struct[part]
+            continue
         #Seperate the key from the qualifier
         key_part = part[:part.index('[')]
         qualifier = part[part.index('[')+1:part.index(']')]
         qualifier_condition = qualifier.split('=')
-        
         #If there is no key part, aka '[0]', '[1]' etc, then it's a simple accessor
-        if key_part is None or key_part == '':
+        if key_part == '':
             if not qualifier.isdigit():
-                raise TypeError(f"ERROR: Full jsonpath: {json_path} - current path - {'.'.join(previous_parts + parts[:1])} - qualifier - {qualifier} - standalone qualifier expected to be a single index numeric ([0], [1], etc)")
+                raise TypeError(f"ERROR: Full jsonpath: {json_path} - current path - {current_path(previous_parts, parts, position)} - qualifier - {qualifier} - standalone qualifier expected to be a single index numeric ([0], [1], etc)")
             if current_struct == {}:
                 current_struct = []
+                if parent_struct is None:
+                    root_struct = current_struct
+                else:
+                    parent_struct[parent_key] = current_struct
             if not isinstance(current_struct, list):
-                raise TypeError(f"ERROR: Full jsonpath: {json_path} - current path - {'.'.join(previous_parts + parts[:1])} - Expected a list, but got {type(current_struct).__name__} instead.")
-            qualifier_as_number = int(qualifier)
-            if qualifier_as_number + 1 > len(current_struct):
-                current_struct.extend({} for x in range (qualifier_as_number + 1 - len(current_struct)))
-            inner_struct = current_struct[qualifier_as_number]
-            inner_struct = build_structure_recurse(inner_struct, json_path, resource_definition, entity_definition, parts, value, previous_parts, part)
-            current_struct[qualifier_as_number] = inner_struct
-            return current_struct
+                raise TypeError(f"ERROR: Full jsonpath: {json_path} - current path - {current_path(previous_parts, parts, position)} - Expected a list, but got {type(current_struct).__name__} instead.")
+            list_index = checked_list_index(qualifier, json_path, previous_parts, parts, position)
+            if list_index + 1 > len(current_struct):
+                current_struct.extend({} for x in range (list_index + 1 - len(current_struct)))
+            if position == last_position:
+                #Actual assigning to the path
+                fhir_formatting.assign_value(current_struct, list_index, value, entity_definition['valueType'], entity_definition.get('valuesets'))
+                break
+            parent_struct, parent_key = current_struct, list_index
+            current_struct = current_struct[list_index]
+            continue
+        #A keyed qualifier as the last part is assigned as a plain key
+        if position == last_position:
+            fhir_formatting.assign_value(current_struct, part, value, entity_definition['valueType'], entity_definition.get('valuesets'))
+            break
         # Create the key part in the structure
         if (not key_part in current_struct) or (isinstance(current_struct[key_part], dict)):
             current_struct[key_part] = []
@@ -279,30 +305,30 @@ def build_structure(current_struct, json_path, resource_definition, entity_defin
             if inner_struct is None:
                 inner_struct = {qualifier_key: qualifier_value}
                 current_struct[key_part].append(inner_struct)
-            #Recurse into that innerstructure where the qualifier matched to continue the part traversal
-            inner_struct = build_structure_recurse(inner_struct, json_path, resource_definition, entity_definition, parts, value, previous_parts, part)
-            return current_struct
+            #Continue the part traversal in the inner structure where the qualifier matched; it is never an empty dict
+            #so it is never replaced and needs no parent
+            parent_struct, parent_key = None, None
+            current_struct = inner_struct
         #If there's no qualifier condition, but an index aka '[0]', '[1]' etc, then it's a simple accessor
         elif qualifier.isdigit():
             if not isinstance(current_struct[key_part], list):
-                raise TypeError(f"ERROR: Full jsonpath: {json_path} - current path - {'.'.join(previous_parts + parts[0])} - Expected a list, but got {type(current_struct).__name__} instead.")
-            qualifier_as_number = int(qualifier)
-            if qualifier_as_number > len(current_struct):
-                current_struct[key_part].extend({} for x in range (qualifier_as_number - len(current_struct)))
-            inner_struct = current_struct[key_part][qualifier_as_number]
-            inner_struct = build_structure_recurse(inner_struct, json_path, resource_definition, entity_definition, parts, value, previous_parts, part)
-            current_struct[key_part][qualifier_as_number] = inner_struct
-            return current_struct
-    #None qualifier accessor
-    else:
-        if(part not in current_struct):
-            current_struct[part] = {}
-        inner_struct = build_structure_recurse(current_struct[part], json_path, resource_definition, entity_definition, parts, value, previous_parts, part)
-        current_struct[part] = inner_struct
-        return current_struct
-    
-#Helper function to quickly recurse and return the next level of structure. Used by main recursive function
-def build_structure_recurse(current_struct, json_path, resource_definition, entity_definition, parts, value, previous_parts, part):
-    previous_parts.append(part)
-    return_struct = build_structure(current_struct, json_path, resource_definition, entity_definition, parts[1:], value, previous_parts)
-    return return_struct
\ No newline at end of file
+                raise TypeError(f"ERROR: Full jsonpath: {json_path} - current path - {current_path(previous_parts, parts, position)} - Expected a list, but got {type(current_struct[key_part]).__name__} instead.")
+            list_index = checked_list_index(qualifier, json_path, previous_parts, parts, position)
+            if list_index + 1 > len(current_struct[key_part]):
+                current_struct[key_part].extend({} for x in range (list_index + 1 - len(current_struct[key_part])))
+            parent_struct, parent_key = current_struct[key_part], list_index
+            current_struct = current_struct[key_part][list_index]
+        else:
+            raise TypeError(f"ERROR: Full jsonpath: {json_path} - current path - {current_path(previous_parts, parts, position)} - qualifier - {qualifier} - expected an index ([0]) or a condition ([system=value]) and no custom handler matched this path")
+    return root_struct
+
+#Parse an index qualifier, refusing indexes that would create an unreasonable number of empty list entries
+def checked_list_index(qualifier, json_path, previous_parts, parts, position):
+    list_index = int(qualifier)
+    if list_index > max_list_index:
+        raise ValueError(f"ERROR: Full jsonpath: {json_path} - current path - {current_path(previous_parts, parts, position)} - index {list_index} is larger than the maximum list index of {max_list_index}")
+    return list_index
+
+#Dot notation of the path walked up to and including the part at position; only built for error messages
+def current_path(previous_parts, parts, position):
+    return '.'.join(list(previous_parts) + parts[:position + 1])
\ No newline at end of file
@@ -1,5 +1,6 @@
 import re
 from datetime import datetime, time, timezone
+import terminology
 
 #Dictionary of regexes
 type_regexes = {
@@ -13,7 +14,8 @@ type_regexes = {
     'uuid':'urn:uuid:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
 }
 # Assign final_struct[key] to value; with formatting given the valueType
-def assign_value(final_struct, key, value, valueType):
+# valueset is the column's Value Set row; codings are checked against it when a terminology index is loaded
+def assign_value(final_struct, key, value, valueType, valueset=None):
     # Removing white space
     if isinstance(value, str):
         value = value.strip()
@@ -35,11 +37,15 @@ def assign_value(final_struct, key, value, valueType):
             final_struct[key] = bool(value)
         elif valueType.lower() == 'codeableconcept':
             final_struct[key] = caret_delimited_string_to_codeableconcept(value)
+            if terminology.active_index is not None:
+                terminology.active_index.check_codings(final_struct[key]['coding'], valueset)
         elif valueType.lower() == 'code':
             match = re.search(type_regexes['code'], value)
             final_struct[key] = match.group(0) if match else ''
         elif valueType.lower() == 'coding':
             final_struct[key] = caret_delimited_string_to_coding(value)
+            if terminology.active_index is not None:
+                terminology.active_index.check_codings([final_struct[key]], valueset)
         elif valueType.lower() == 'date':
             if isinstance(value, datetime):
                 final_struct[key] = value.date()
@@ -258,6 +264,37 @@ def caret_delimited_string_to_coding(caret_delimited_str):
         coding['display'] = parts[2] if parts[2] else ''
     return coding
 
+#Inverse of caret_delimited_string_to_codeableconcept: "system^code^display~system^code^display^text"
+def codeableconcept_to_caret_delimited_string(codeable_concept):
+    coding_strings = [coding_to_caret_delimited_string(coding) for coding in codeable_concept.get('coding', []) if isinstance(coding, dict)]
+    if 'text' in codeable_concept:
+        #The text rides along as a fourth part of the last coding
+        last_parts = coding_strings.pop().split('^') if coding_strings else []
+        last_parts += [''] * (3 - len(last_parts))
+        coding_strings.append('^'.join(last_parts + [str(codeable_concept['text'])]))
+    return '~'.join(coding_strings)
+
+#Inverse of caret_delimited_string_to_coding; parts are only written as far as the coding has them
+def coding_to_caret_delimited_string(coding):
+    parts = [coding.get('system'), coding.get('code'), coding.get('display')]
+    while len(parts) > 1 and parts[-1] is None:
+        parts.pop()
+    return '^'.join('' if part is None else str(part) for part in parts)
+
+#Inverse of string_to_quantity: "value^unit"
+def quantity_to_string(quantity):
+    value = quantity.get('value', '')
+    if 'unit' in quantity:
+        return f"{value}^{quantity['unit']}"
+    return str(value)
+
+#Inverse of parse_flexible_address: "line^city^district^state^postalCode^country"
+def address_to_caret_delimited_string(address):
+    line = address.get('line', '')
+    if isinstance(line, list):
+        line = ', '.join(str(item) for item in line)
+    return '^'.join([str(line)] + [str(address.get(key, '')) for key in ('city', 'district', 'state', 'postalCode', 'country')])
+
 def string_to_quantity(quantity_str):
     # Split the string into value and unit by whitespace
     parts = quantity_str.split('^',maxsplit=1)
@@ -1,23 +1,69 @@
 import read_input
 import conversion
+import serialization
+import bundling
+import writer
+import terminology
+import sharding
+import memory_budget
+import compressed_io
+import bundle_prefetch
 
 import argparse
 import orjson
-import json
 from pathlib import Path
 
-def find_sets(d, path=""):
-    if isinstance(d, dict):
-        for key, value in d.items():
-            new_path = f"{path}.{key}" if path else str(key)
-            find_sets(value, new_path)
-    elif isinstance(d, list):  # Handle lists of dictionaries
-        for idx, item in enumerate(d):
-            find_sets(item, f"{path}[{idx}]")
-    elif isinstance(d, set):
-        print(f"Set found at path: {path}")
-        
-def main(input_file, output_folder):
+#Render a bundle dict as compact or pretty printed json bytes
+def render_bundle(fhir_bundle, compact=False, schema=None):
+    #orjson knows how to render datetimes and rejects anything that is not plain json with its path
+    json_bytes = serialization.dumps(fhir_bundle, schema)
+    if not compact:
+        #Only needed for the pretty printed output; keep it off the import path of the module
+        import json
+        #Round trip through orjson in memory before pretty printing
+        json_bytes = json.dumps(orjson.loads(json_bytes), indent = 4).encode()
+    return json_bytes
+
+#Library entry point: build the bundle of a single patient, reading only the header rows and that patient's row.
+#index counts data rows from the first data row of PatientData, the same numbering as the output files
+def generate_patient(input_file, index):
+    data = read_input.read_xlsx_and_process(input_file, rows=(index, index))
+    if data['num_entries'] == 0:
+        raise IndexError(f"Patient index {index} has no data in {input_file}")
+    return conversion.create_transaction_bundle(data['resource_definition_entities'], data['resource_link_entities'],
+                                                data['patient_data_entities'], 0, data['row_fields'][0])
+
+#Library entry point for pipelines: lazily yield the bundle of every patient, in patient index order, without writing
+#any file. Bundles are dicts, or compact json bytes with as_bytes; with_index yields (patient index, bundle) pairs.
+# rows: optional inclusive (first, last) range of patient indexes
+# prefetch: number of bundles built ahead of the consumer on a background thread, or per worker process
+# processes: number of worker processes building bundles in parallel, each reading every processes-th patient
+# batch_rows: number of patient rows read from the workbook at a time
+# prune_empty: leave out resources the row has no data for, and the links to them
+def iter_bundles(input_file, rows=None, as_bytes=False, with_index=False, prefetch=0, processes=1, batch_rows=1000, prune_empty=False):
+    if processes > 1:
+        bundles = bundle_prefetch.in_processes(iter_patient_bundles, (input_file, rows, as_bytes, batch_rows, prune_empty), processes, prefetch)
+    elif prefetch > 0:
+        bundles = bundle_prefetch.in_thread(iter_patient_bundles(input_file, rows, as_bytes, batch_rows, prune_empty), prefetch)
+    else:
+        bundles = iter_patient_bundles(input_file, rows, as_bytes, batch_rows, prune_empty)
+    try:
+        for row_index, bundle in bundles:
+            yield (row_index, bundle) if with_index else bundle
+    finally:
+        bundles.close()
+
+#(patient index, bundle) of every requested patient, each bundle built only once it is asked for
+def iter_patient_bundles(input_file, rows=None, as_bytes=False, batch_rows=1000, prune_empty=False, shard=None):
+    for batch in read_input.iter_xlsx_batches(input_file, rows, shard, batch_rows):
+        for i in range(batch['num_entries']):
+            bundle = conversion.create_transaction_bundle(batch['resource_definition_entities'], batch['resource_link_entities'],
+                                                          batch['patient_data_entities'], i, batch['row_fields'][i], prune_empty)
+            yield batch['row_indexes'][i], serialization.dumps(bundle) if as_bytes else bundle
+
+def main(input_file, output_folder, compact=False, validate_schema=False, max_entries=None, max_bytes=None, rows=None,
+         writer_threads=1, fsync=False, terminology_paths=None, shard=None, max_memory=None, trace_allocations=False,
+         compression=None, ndjson=False, prune_empty=False, read_processes=None):
     # Step 1: Read the input file using read_input module
     
     # Check if the output folder exists, and create it if not
@@ -27,25 +73,106 @@ def main(input_file, output_folder):
         output_folder_path = Path().cwd() / Path(output_folder)
     if not output_folder_path.exists():
         output_folder_path.mkdir(parents=True, exist_ok=True)  # Create the folder if it doesn't exist
-    data = read_input.read_xlsx_and_process(input_file)
+    #Gzip or zstd compression runs on the writer threads; compressed files get the suffix of the codec
+    codec = compressed_io.get_codec(compression) if compression else None
+    suffix = codec.suffix if codec is not None else ""
+    #With a memory budget PatientData is read in batches sized to the budget and every phase records its peak memory
+    memory = memory_budget.MemoryBudget(max_memory, trace_allocations)
+    batches = read_input.iter_xlsx_batches(input_file, rows, shard, memory.batch_rows, read_processes)
+    with memory.phase('read'):
+        data = next(batches)
     resource_definition_entities = data['resource_definition_entities']
+    #Patient indexes written so far and the highest index of the sheet, for the shard manifest
+    progress = {'row_indexes': [], 'last_row_index': data['last_row_index']}
+    
+    #Optional structural check of every resource against the json templates, done while serializing
+    schema = serialization.compile_bundle_schema() if validate_schema else None
+    
+    #Check codings against local ValueSet/CodeSystem files and fill in missing displays while the bundles of this run are built
+    terminology_index = None
+    if terminology_paths:
+        terminology_index = terminology.load_terminology(terminology_paths)
+        memory.register_cache('terminology', terminology_index.checked.clear)
+    
+    #Every batch of patients in turn, the next one only read once the previous one was converted
+    def read_batches(batch):
+        while batch is not None:
+            progress['row_indexes'].extend(batch['row_indexes'])
+            progress['last_row_index'] = batch['last_row_index']
+            yield batch
+            batch = None
+            with memory.phase('read'):
+                batch = next(batches, None)
     
-    #For each index of patients
-    for i in range(0,data['num_entries']):
-        # Construct the file path for each JSON file
-        file_path = output_folder_path / f"{i}.json"
-        #Create a bundle
-        fhir_bundle = conversion.create_transaction_bundle(data['resource_definition_entities'],
-                                                        data['resource_link_entities'], data['patient_data_entities'], i)
-        # Step 3: Write the processed data to the output file
-        find_sets(fhir_bundle)
-        json_string = orjson.dumps(fhir_bundle)
-        with open(file_path, 'wb') as json_file:
-            json_file.write(json_string)
-        with open(file_path, 'r') as json_file:
-            json_string = json.load(json_file)
-        with open(file_path, 'w') as json_file:
-            json.dump(json_string, json_file, indent = 4)
+    #Bundle numbers restart in every shard, so shards prefix them to keep file names unique across nodes
+    name_prefix = f"shard-{shard[0]}-of-{shard[1]}-" if shard is not None else ""
+    #Names of the files written, recorded in the shard manifest
+    file_names = []
+    bundle_count = 0
+    if ndjson:
+        #Every bundle is one line of a single stream file, so bundles are always compact
+        compact = True
+        file_names.append(f"{name_prefix}bundles.ndjson{suffix}")
+        bundle_writer = writer.StreamWriter(output_folder_path / file_names[-1], threads=writer_threads, fsync=fsync,
+                                            max_pending_bytes=memory.max_pending_bytes, compress=codec and codec.compress)
+    else:
+        #Files are written on background threads while the next bundles are built
+        bundle_writer = writer.BackgroundWriter(threads=writer_threads, fsync=fsync, max_pending_bytes=memory.max_pending_bytes,
+                                                compress=codec and codec.compress)
+    
+    def write_bundle(file_name, json_bytes):
+        nonlocal bundle_count
+        bundle_count += 1
+        if ndjson:
+            bundle_writer.submit(json_bytes)
+        else:
+            file_names.append(file_name + suffix)
+            bundle_writer.submit(output_folder_path / file_names[-1], json_bytes)
+        memory.relieve_pressure(bundle_writer)
+    
+    with bundle_writer, terminology.activated(terminology_index):
+        #Repack patient entries into size limited transactions; files are then numbered per bundle rather than per patient
+        if max_entries is not None or max_bytes is not None:
+            packer = bundling.TransactionBundlePacker(max_entries, max_bytes)
+            patient_entries = (conversion.create_transaction_bundle(batch['resource_definition_entities'], batch['resource_link_entities'],
+                                                                    batch['patient_data_entities'], i, batch['row_fields'][i], prune_empty)['entry']
+                               for batch in read_batches(data) for i in range(0, batch['num_entries']))
+            with memory.phase('convert'):
+                for n, fhir_bundle in enumerate(packer.pack(patient_entries)):
+                    write_bundle(f"{name_prefix}{n}.json", render_bundle(fhir_bundle, compact, schema))
+            print(packer.report())
+        else:
+            for batch in read_batches(data):
+                with memory.phase('convert'):
+                    #For each index of patients
+                    for i in range(0,batch['num_entries']):
+                        # Each JSON file is named after the patient index of its row
+                        file_name = f"{batch['row_indexes'][i]}.json"
+                        #Create a bundle
+                        fhir_bundle = conversion.create_transaction_bundle(batch['resource_definition_entities'],
+                                                                        batch['resource_link_entities'], batch['patient_data_entities'], i,
+                                                                        batch['row_fields'][i], prune_empty)
+                        # Step 3: Write the processed data to the output file
+                        write_bundle(file_name, render_bundle(fhir_bundle, compact, schema))
+                #Drop the cell values of this batch before the next one is read
+                data = batch = None
+        #Files are written on the writer threads while bundles are built, so this only times the wait for the files still
+        #queued after the last bundle; the writers' own time is recorded separately once they are closed
+        with memory.phase('drain'):
+            bundle_writer.wait_until_written()
+    memory.record_background('write', bundle_writer.busy_seconds)
+    print_terminology_report(terminology_index)
+    #Written once every file is on disk, so a manifest is only present for a shard that finished
+    if shard is not None:
+        manifest_path = sharding.write_shard_manifest(output_folder_path, input_file, shard, progress, file_names, rows)
+        print(f"Shard {shard[0]} of {shard[1]}: {len(progress['row_indexes'])} patients, manifest written to {manifest_path}")
+    if memory.enabled:
+        memory.write_report(output_folder_path / 'run_report.json', {'input_file': str(input_file), 'bundles': bundle_count})
+        memory.close()
+
+def print_terminology_report(terminology_index):
+    if terminology_index is not None:
+        print(terminology_index.report())
 
 if __name__ == "__main__":
     # Create the argparse CLI
@@ -57,8 +184,44 @@ if __name__ == "__main__":
     # Define the output file argument
     parser.add_argument('--output_folder', type=str, help="Path to save the output files", default="output/")
     
+    parser.add_argument('--compact', action='store_true', help="Write compact json instead of indented json; much faster for large cohorts")
+    
+    parser.add_argument('--validate_schema', action='store_true', help="Check generated resources against the json templates in resources/json_templates")
+    
+    parser.add_argument('--max_entries', type=int, help="Maximum number of entries per transaction bundle; patients are split or packed together to fit", default=None)
+    
+    parser.add_argument('--max_bytes', type=int, help="Maximum size in bytes of a transaction bundle as compact json; patients are split or packed together to fit", default=None)
+    
+    parser.add_argument('--rows', type=read_input.parse_row_range, help="Only generate the patients in this inclusive range of data rows, e.g. 120-130 (0 is the first data row)", default=None)
+    
+    parser.add_argument('--read_processes', type=int, help="Number of processes parsing the PatientData rows of the workbook in parallel", default=None)
+    
+    parser.add_argument('--writer_threads', type=int, help="Number of background threads writing files while bundles are built", default=1)
+    
+    parser.add_argument('--fsync', action='store_true', help="Flush every written file to disk once all bundles are written")
+    
+    parser.add_argument('--shard', type=sharding.parse_shard, help="Only generate shard K of N, e.g. 2/8: the patients whose index %% N is K - 1. Writes a manifest to merge with sharding.py", default=None)
+    
+    parser.add_argument('--compression', type=str, choices=['gzip', 'zstd'], help="Compress every output file with gzip or zstd (zstd needs Python 3.14 or the zstandard package), on the writer threads", default=None)
+    
+    parser.add_argument('--ndjson', action='store_true', help="Write all bundles as the lines of one bundles.ndjson file instead of one file per bundle; implies --compact")
+    
+    parser.add_argument('--prune_empty', action='store_true', help="Leave out resources a patient row has no data for, and the references to them, instead of writing bare resources")
+    
+    parser.add_argument('--max_memory', type=memory_budget.parse_memory_size, help="Keep resident memory near this size, e.g. 2G: read patients in batches, bound the bundles waiting to be written and write a run_report.json with the peak memory of every phase", default=None)
+    
+    parser.add_argument('--trace_allocations', action='store_true', help="Add the peak of traced Python allocations and the top allocators of every phase to run_report.json; several times slower")
+    
+    parser.add_argument('--terminology', type=str, nargs='+', help="ValueSet/CodeSystem json or csv files (or folders of them) to check codings against", default=None)
+    
     # Parse the arguments
     args = parser.parse_args()
+    if args.compression and not compressed_io.codec_available(args.compression):
+        parser.error(f"--compression {args.compression} needs Python 3.14 or the zstandard package (pip install zstandard)")
 
     # Call the main function with the provided arguments
-    main(args.input_file, args.output_folder)
\ No newline at end of file
+    main(args.input_file, args.output_folder, compact=args.compact, validate_schema=args.validate_schema, max_entries=args.max_entries,
+         max_bytes=args.max_bytes, rows=args.rows, writer_threads=args.writer_threads, fsync=args.fsync,
+         terminology_paths=args.terminology, shard=args.shard, max_memory=args.max_memory,
+         trace_allocations=args.trace_allocations, compression=args.compression, ndjson=args.ndjson,
+         prune_empty=args.prune_empty, read_processes=args.read_processes)
\ No newline at end of file
@@ -0,0 +1,349 @@
+import read_input
+import fhir_formatting
+import compressed_io
+
+import argparse
+import re
+import time
+from datetime import date
+from pathlib import Path
+import orjson
+
+# Turns FHIR bundles back into PatientData rows of a workbook. The columns of the workbook (Entity To Query, JsonPath and
+# Data Type) are compiled once into extractors; each bundle is then a walk over its entries and one extractor call per
+# column, without parsing any jsonpath per value. One bundle becomes one patient row.
+class BundleFlattener:
+    def __init__(self, resource_definition_entities, columns):
+        self.resource_definition_entities = resource_definition_entities
+        self.columns = columns
+        definitions_by_entity = {definition['Entity Name']: definition for definition in resource_definition_entities}
+        #List items written by handler and [key=value] qualifier columns, per entity: {list path: [predicate, ...]}
+        claims = {}
+        for entity_name, json_path, value_type in columns:
+            definition = definitions_by_entity.get(entity_name)
+            if definition is not None and json_path:
+                for list_path, predicate in column_claims(json_path, definition['ResourceType'].strip()):
+                    claims.setdefault(entity_name, {}).setdefault(list_path, []).append(predicate)
+        #Columns reading the same string[] path pick successive items of its list, in column order
+        occurrences = {}
+        self.extractors = []
+        for entity_name, json_path, value_type in columns:
+            definition = definitions_by_entity.get(entity_name)
+            if definition is None or not json_path:
+                self.extractors.append(None)
+                continue
+            occurrence = 0
+            if (value_type or '').lower() == 'string[]':
+                occurrence = occurrences.get((entity_name, json_path), 0)
+                occurrences[(entity_name, json_path)] = occurrence + 1
+            self.extractors.append((entity_name, compile_extractor(json_path, definition['ResourceType'].strip(), value_type, occurrence,
+                                                                   claims.get(entity_name, {}))))
+        self.unmatched_resource_types = set()
+
+    #Cells of the PatientData row for one bundle, from the third column on
+    def flatten(self, bundle):
+        resources = self.match_entities(bundle)
+        row = []
+        for extractor in self.extractors:
+            if extractor is None:
+                row.append(None)
+                continue
+            entity_name, extract = extractor
+            resource = resources.get(entity_name)
+            row.append(extract(resource) if resource is not None else None)
+        return row
+
+    #Assign the bundle's resources to the workbook's entities. Entities are taken in ResourceDefinitions order, each one
+    #getting the first unassigned resource of its type, preferring a resource that declares one of its profiles
+    def match_entities(self, bundle):
+        remaining = [entry.get('resource') for entry in bundle.get('entry', []) if isinstance(entry, dict) and isinstance(entry.get('resource'), dict)]
+        resources = {}
+        for definition in self.resource_definition_entities:
+            resource_type = definition['ResourceType'].strip()
+            candidates = [resource for resource in remaining if resource.get('resourceType') == resource_type]
+            if not candidates:
+                continue
+            profiles = set(definition['Profile(s)'] or [])
+            resource = next((candidate for candidate in candidates if profiles.intersection(candidate.get('meta', {}).get('profile', []))), candidates[0])
+            resources[definition['Entity Name']] = resource
+            remaining.remove(resource)
+        for resource in remaining:
+            if resource.get('resourceType') not in self.unmatched_resource_types:
+                self.unmatched_resource_types.add(resource.get('resourceType'))
+                print(f"WARNING: - Flattening - {resource.get('resourceType')} - resources of this type have no entity left in the ResourceDefinitions tab and are not flattened")
+        return resources
+
+#Build the function reading one column's cell value out of a resource. claims are the list items other columns of the
+#entity write (see column_claims); a positional index such as identifier.[0] counts only the items no other column owns
+def compile_extractor(json_path, resource_type, value_type, occurrence = 0, claims = None):
+    inverse_handler = next((inverse_handlers[handler] for handler in inverse_handlers if json_path.startswith(handler)), None)
+    if inverse_handler is not None:
+        read_value = inverse_handler(json_path, resource_type)
+    else:
+        steps = skip_claimed_items(compile_steps(json_path.split('.'), resource_type), claims or {})
+        read_value = lambda resource: follow_steps(resource, steps)
+    def extract(resource):
+        return to_cell(read_value(resource), value_type, occurrence)
+    return extract
+
+#Turn the parts of a jsonpath into the steps conversion.build_structure takes to create it:
+#('key', name), ('index', n) or ('match', key, qualifier key, qualifier value)
+def compile_steps(parts, resource_type):
+    steps = []
+    last_position = len(parts) - 1
+    for position, part in enumerate(parts):
+        if part == '$' or part == resource_type:
+            continue
+        if not ('[' in part and ']' in part):
+            steps.append(('key', part))
+            continue
+        key_part = part[:part.index('[')]
+        qualifier = part[part.index('[')+1:part.index(']')]
+        qualifier_condition = qualifier.split('=')
+        if key_part == '':
+            if not qualifier.isdigit():
+                raise TypeError(f"ERROR: Full jsonpath: {'.'.join(parts)} - qualifier - {qualifier} - standalone qualifier expected to be a single index numeric ([0], [1], etc)")
+            steps.append(('index', int(qualifier)))
+        elif position == last_position:
+            #build_structure assigns a keyed qualifier in the last part as a plain key
+            steps.append(('key', part))
+        elif len(qualifier_condition) == 2:
+            steps.append(('match', key_part, qualifier_condition[0], qualifier_condition[1]))
+        elif qualifier.isdigit():
+            steps.append(('key', key_part))
+            steps.append(('index', int(qualifier)))
+        else:
+            raise TypeError(f"ERROR: Full jsonpath: {'.'.join(parts)} - qualifier - {qualifier} - expected an index ([0]) or a condition ([system=value])")
+    return steps
+
+# When a template fills a list both by position and through handler or qualifier columns, the items those columns
+# create shift the positions: with identifier.[0] empty, the MRN identifier is the first item of the list. The first
+# positional index under such a list becomes ('unclaimed index', n, predicates), counting only the items none of the
+# predicates match.
+def skip_claimed_items(steps, claims):
+    keys = []
+    for position, step in enumerate(steps):
+        if step[0] == 'index' and tuple(keys) in claims:
+            return steps[:position] + [('unclaimed index', step[1], claims[tuple(keys)])] + steps[position + 1:]
+        if step[0] != 'key':
+            break
+        keys.append(step[1])
+    return steps
+
+#(list path, predicate) of the list items a column writes through a custom handler or a [key=value] qualifier
+def column_claims(json_path, resource_type):
+    handler = next((handler for handler in handler_claims if json_path.startswith(handler)), None)
+    if handler is not None:
+        return [handler_claims[handler](json_path)]
+    if json_path.startswith(tuple(inverse_handlers)):
+        return []
+    keys = []
+    for step in compile_steps(json_path.split('.'), resource_type):
+        if step[0] == 'match':
+            qualifier_key, qualifier_value = step[2], step[3]
+            return [(tuple(keys + [step[1]]), lambda item: item.get(qualifier_key) == qualifier_value)]
+        if step[0] != 'key':
+            break
+        keys.append(step[1])
+    return []
+
+def follow_steps(value, steps):
+    for step in steps:
+        if step[0] == 'key':
+            value = value.get(step[1]) if isinstance(value, dict) else None
+        elif step[0] == 'index':
+            value = value[step[1]] if isinstance(value, list) and step[1] < len(value) else None
+        elif step[0] == 'unclaimed index':
+            items = [item for item in value if not (isinstance(item, dict) and any(claimed(item) for claimed in step[2]))] if isinstance(value, list) else []
+            value = items[step[1]] if step[1] < len(items) else None
+        else:
+            items = value.get(step[1]) if isinstance(value, dict) else None
+            value = next((item for item in items if isinstance(item, dict) and item.get(step[2]) == step[3]), None) if isinstance(items, list) else None
+        if value is None:
+            return None
+    return value
+
+#Write a value found in a resource the way the Data Type column expects to read it
+def to_cell(value, value_type, occurrence = 0):
+    if value is None:
+        return None
+    value_type = (value_type or '').lower()
+    if value_type == 'string[]' and isinstance(value, list):
+        value = value[occurrence] if occurrence < len(value) else None
+    elif value_type == 'codeableconcept' and isinstance(value, dict):
+        value = fhir_formatting.codeableconcept_to_caret_delimited_string(value)
+    elif value_type == 'coding' and isinstance(value, dict):
+        value = fhir_formatting.coding_to_caret_delimited_string(value)
+    elif value_type == 'quantity' and isinstance(value, dict):
+        value = fhir_formatting.quantity_to_string(value)
+    elif value_type == 'address' and isinstance(value, dict):
+        value = fhir_formatting.address_to_caret_delimited_string(value)
+    elif value_type == 'date' and isinstance(value, str) and re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+        #A date cell regenerates as a plain date; a date string would be regenerated as a datetime
+        value = date.fromisoformat(value)
+    if isinstance(value, (dict, list)):
+        return orjson.dumps(value).decode()
+    return value
+
+def find_with(items, key, value):
+    if not isinstance(items, list):
+        return None
+    return next((item for item in items if isinstance(item, dict) and item.get(key) == value), None)
+
+#Inverses of the special_values custom handlers, keyed the same way. Each takes the column's jsonpath and returns a
+#function reading the value the handler would have been given
+def inverse_omb_extension(url):
+    def compile_handler(json_path, resource_type):
+        def read_value(resource):
+            extension = find_with(resource.get('extension'), 'url', url)
+            omb_category = find_with(extension.get('extension'), 'url', 'ombCategory') if extension else None
+            return omb_category.get('valueCoding', {}).get('display') if omb_category else None
+        return read_value
+    return compile_handler
+
+def inverse_birthsex(json_path, resource_type):
+    def read_value(resource):
+        extension = find_with(resource.get('extension'), 'url', 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex')
+        return extension.get('valueCode') if extension else None
+    return read_value
+
+def inverse_identifier_type(type_code):
+    def compile_handler(json_path, resource_type):
+        key = json_path.split('.')[-1]
+        def read_value(resource):
+            for identifier in resource.get('identifier', []):
+                if any(coding.get('code') == type_code for coding in identifier.get('type', {}).get('coding', [])):
+                    return identifier.get(key)
+            return None
+        return read_value
+    return compile_handler
+
+def inverse_identifier_system(system):
+    def compile_handler(json_path, resource_type):
+        def read_value(resource):
+            identifier = find_with(resource.get('identifier'), 'system', system)
+            return identifier.get('value') if identifier else None
+        return read_value
+    return compile_handler
+
+def inverse_observation_component(json_path, resource_type):
+    parts = json_path.split('.')
+    qualifier = parts[1][parts[1].index('[')+1:parts[1].index(']')]
+    code = qualifier.split('=')[-1]
+    steps = compile_steps(parts[2:], resource_type)
+    def read_value(resource):
+        component = next((component for component in resource.get('component', [])
+                          if any(coding.get('code') == code for coding in component.get('code', {}).get('coding', []))), None)
+        return follow_steps(component, steps) if component else None
+    return read_value
+
+def has_type_code(item, type_code):
+    return any(coding.get('code') == type_code for coding in item.get('type', {}).get('coding', []))
+
+def component_claim(json_path):
+    qualifier = json_path.split('.')[1]
+    code = qualifier[qualifier.index('[')+1:qualifier.index(']')].split('=')[-1]
+    return ('component',), lambda item: any(coding.get('code') == code for coding in item.get('code', {}).get('coding', []))
+
+#The list items each custom handler creates, keyed like inverse_handlers; values take the column's jsonpath
+handler_claims = {
+    "Patient.extension[Race].ombCategory": lambda json_path: (('extension',), lambda item: item.get('url') == 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race'),
+    "Patient.extension[Ethnicity].ombCategory": lambda json_path: (('extension',), lambda item: item.get('url') == 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity'),
+    "Patient.extension[Birthsex].value": lambda json_path: (('extension',), lambda item: item.get('url') == 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex'),
+    "Patient.identifier[type=MR].": lambda json_path: (('identifier',), lambda item: has_type_code(item, 'MR')),
+    "Patient.identifier[type=MRN].": lambda json_path: (('identifier',), lambda item: has_type_code(item, 'MR')),
+    "Patient.identifier[type=SSN].": lambda json_path: (('identifier',), lambda item: has_type_code(item, 'SS')),
+    "Organization.identifier[system=NPI].value": lambda json_path: (('identifier',), lambda item: item.get('system') == "http://hl7.org.fhir/sid/us-npi"),
+    "Organization.identifier[system=CLIA].value": lambda json_path: (('identifier',), lambda item: item.get('system') == "urn:oid:2.16.840.1.113883.4.7"),
+    "Practitioner.identifier[system=NPI].value": lambda json_path: (('identifier',), lambda item: item.get('system') == "http://hl7.org.fhir/sid/us-npi"),
+    "Observation.component[": component_claim
+}
+
+inverse_handlers = {
+    "Patient.extension[Race].ombCategory": inverse_omb_extension('http://hl7.org/fhir/us/core/StructureDefinition/us-core-race'),
+    "Patient.extension[Ethnicity].ombCategory": inverse_omb_extension('http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity'),
+    "Patient.extension[Birthsex].value": inverse_birthsex,
+    "Patient.identifier[type=MR].": inverse_identifier_type('MR'),
+    "Patient.identifier[type=MRN].": inverse_identifier_type('MR'),
+    "Patient.identifier[type=SSN].": inverse_identifier_type('SS'),
+    "Organization.identifier[system=NPI].value": inverse_identifier_system("http://hl7.org.fhir/sid/us-npi"),
+    "Organization.identifier[system=CLIA].value": inverse_identifier_system("urn:oid:2.16.840.1.113883.4.7"),
+    "Practitioner.identifier[system=NPI].value": inverse_identifier_system("http://hl7.org.fhir/sid/us-npi"),
+    "Observation.component[": inverse_observation_component
+}
+
+#Sort 2.json before 10.json, so bundles written per patient index come back in patient order
+def natural_sort_key(path):
+    return [int(piece) if piece.isdigit() else piece for piece in re.split(r'(\d+)', str(path))]
+
+#Lazily yield the bundles in json files, ndjson files (one bundle per line) and folders of them. Gzip and zstd
+#compressed files (such as 0.json.gz or bundles.ndjson.zst) are decompressed as they are read
+def read_bundles(paths):
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from read_bundles(sorted((file_path for file_path in path.rglob('*') if compressed_io.uncompressed_suffix(file_path) in ('.json', '.ndjson')), key=natural_sort_key))
+        elif compressed_io.uncompressed_suffix(path) == '.ndjson':
+            with compressed_io.open_input(path) as input_file:
+                for line in input_file:
+                    if line.strip():
+                        yield orjson.loads(line)
+        else:
+            yield orjson.loads(compressed_io.read_bytes(path))
+
+#The ResourceDefinitions and the header rows of PatientData of a workbook
+def read_template(template_file):
+    import openpyxl
+    workbook = openpyxl.load_workbook(template_file, read_only=True)
+    resource_definition_entities = read_input.process_sheet_resource_definitions(read_input.read_only_sheet(workbook, 'ResourceDefinitions'))
+    header_rows = [list(row) for row in read_input.read_only_sheet(workbook, 'PatientData').iter_rows(min_row=1, max_row=read_input.first_data_row - 1, values_only=True)]
+    workbook.close()
+    width = max((len(row) for row in header_rows), default=0)
+    header_rows = [row + [None] * (width - len(row)) for row in header_rows]
+    #(Entity To Query, JsonPath, Data Type) of every column from the third on
+    columns = [(col[0], col[1], col[2]) for col in list(zip(*header_rows))[2:]]
+    return resource_definition_entities, header_rows, columns
+
+def main(template_file, input_paths, output_file):
+    start = time.perf_counter()
+    resource_definition_entities, header_rows, columns = read_template(template_file)
+    flattener = BundleFlattener(resource_definition_entities, columns)
+    rows = ([None, None] + flattener.flatten(bundle) for bundle in read_bundles(input_paths) if bundle.get('resourceType') == 'Bundle')
+    if Path(output_file).suffix.lower() == '.csv':
+        row_count = write_csv(output_file, header_rows, rows)
+    else:
+        row_count = write_xlsx(template_file, output_file, rows)
+    print(f"Flattened {row_count} bundles into {output_file} in {time.perf_counter() - start:.1f}s")
+
+#Csv with the same layout as the PatientData sheet: the header rows, then one row per bundle
+def write_csv(output_file, header_rows, rows):
+    import csv
+    row_count = 0
+    with open(output_file, 'w', newline='', encoding='utf-8') as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerows(header_rows)
+        for row in rows:
+            csv_writer.writerow(row)
+            row_count += 1
+    return row_count
+
+#Copy of the template workbook with its PatientData rows replaced by one row per bundle, ready to edit and regenerate
+def write_xlsx(template_file, output_file, rows):
+    import openpyxl
+    workbook = openpyxl.load_workbook(template_file)
+    sheet = workbook['PatientData']
+    if sheet.max_row >= read_input.first_data_row:
+        sheet.delete_rows(read_input.first_data_row, sheet.max_row - read_input.first_data_row + 1)
+    row_count = 0
+    for row in rows:
+        sheet.append(row)
+        row_count += 1
+    workbook.save(output_file)
+    return row_count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flatten FHIR bundles back into the PatientData rows of a workbook.")
+    parser.add_argument('--template_file', type=str, help="Workbook whose ResourceDefinitions and PatientData columns describe the rows", default="resources/Fhir_Cohort_Import_Template_Full_Sample.xlsx")
+    parser.add_argument('--input', type=str, nargs='+', help="Bundle json files, ndjson files with one bundle per line, or folders of them; they may be gzip or zstd compressed", required=True)
+    parser.add_argument('--output_file', type=str, help="Path of the xlsx (a copy of the template) or csv to write", default="flattened.xlsx")
+    args = parser.parse_args()
+    main(args.template_file, args.input, args.output_file)
@@ -0,0 +1,298 @@
+import read_input
+import conversion
+import fhirsheets
+
+import argparse
+import contextlib
+import importlib
+import io
+import random
+import re
+import sys
+import time
+import uuid
+from pathlib import Path
+import orjson
+
+# Differential check of the bundle builders. Every workbook is read once, then every patient is built by each engine with
+# the same deterministic ids, and the normalized bundles are compared with the golden snapshot stored for the workbook in
+# resources/golden, or with those of the reference engine when there is none. An engine is a function (data, index) ->
+# bundle, where data is what read_input.read_xlsx_and_process returns and the bundle is a dict or json bytes. New fast
+# paths are checked by adding them here or passing them as --candidate module:function. Row ranges and shards read through
+# the sheet xml filter of read_input are compared with the regular parse as well.
+
+#Golden snapshots, <workbook name>.json, and the multi-row fixture workbooks they are taken from besides the templates
+golden_folder = Path(__file__).resolve().parent / 'resources' / 'golden'
+
+#The behaviour the other engines have to match: every field of every entity checked cell by cell, without the sparse
+#row index the reader builds
+def reference_engine(data, index):
+    return conversion.create_transaction_bundle(data['resource_definition_entities'], data['resource_link_entities'],
+                                                data['patient_data_entities'], index)
+
+#Only the cells holding a value, through the sparse row index
+def sparse_engine(data, index):
+    return conversion.create_transaction_bundle(data['resource_definition_entities'], data['resource_link_entities'],
+                                                data['patient_data_entities'], index, data['row_fields'][index])
+
+#Compact json, as written with --compact
+def compact_engine(data, index):
+    return fhirsheets.render_bundle(sparse_engine(data, index), compact=True)
+
+#Indented json, as written without --compact
+def pretty_engine(data, index):
+    return fhirsheets.render_bundle(sparse_engine(data, index), compact=False)
+
+engines = {
+    'reference': reference_engine,
+    'sparse': sparse_engine,
+    'compact': compact_engine,
+    'pretty': pretty_engine
+}
+
+#Load an engine given as module:function
+def load_engine(spec):
+    module_name, _, function_name = spec.partition(':')
+    if not function_name:
+        raise ValueError(f"ERROR: - Golden Harness - candidate '{spec}' is expected to look like module:function")
+    return getattr(importlib.import_module(module_name), function_name)
+
+#uuid4 replaced by a generator seeded from seed, so every engine gives a patient the same ids in the same order
+@contextlib.contextmanager
+def deterministic_ids(seed):
+    generator = random.Random(seed)
+    original_uuid4 = uuid.uuid4
+    uuid.uuid4 = lambda: uuid.UUID(int=generator.getrandbits(128), version=4)
+    try:
+        yield
+    finally:
+        uuid.uuid4 = original_uuid4
+
+#Plain json values of a bundle, whichever form an engine returned it in; key order and formatting no longer matter
+def normalize(bundle):
+    if isinstance(bundle, (bytes, str)):
+        return orjson.loads(bundle)
+    return orjson.loads(orjson.dumps(bundle))
+
+uuid_pattern = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+#Every uuid replaced by 'id-1', 'id-2', ... in order of first appearance, visiting keys in sorted order, so a snapshot
+#does not depend on how many ids an engine draws, in which order, or in which order it writes keys
+def number_ids(bundle):
+    ids = {}
+    def collect(value):
+        if isinstance(value, dict):
+            for key in sorted(value):
+                collect(value[key])
+        elif isinstance(value, list):
+            for item in value:
+                collect(item)
+        elif isinstance(value, str):
+            for found in uuid_pattern.findall(value):
+                ids.setdefault(found, f"id-{len(ids) + 1}")
+    def replace(value):
+        if isinstance(value, dict):
+            return {key: replace(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [replace(item) for item in value]
+        if isinstance(value, str):
+            return uuid_pattern.sub(lambda match: ids[match.group(0)], value)
+        return value
+    collect(bundle)
+    return replace(bundle)
+
+def golden_path(input_file):
+    return golden_folder / (Path(input_file).stem + '.json')
+
+#{patient index: bundle} of a workbook's golden snapshot, or None when it has none
+def read_golden(input_file):
+    path = golden_path(input_file)
+    if not path.exists():
+        return None
+    return {patient['row_index']: patient['bundle'] for patient in orjson.loads(path.read_bytes())}
+
+def write_golden(input_file, bundles):
+    path = golden_path(input_file)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(orjson.dumps([{'row_index': row_index, 'bundle': bundle} for row_index, bundle in bundles], option=orjson.OPT_INDENT_2) + b'\n')
+    return path
+
+#Paths where two json values differ, with both values
+def find_differences(expected, actual, path = ""):
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        for key in list(expected) + [key for key in actual if key not in expected]:
+            yield from find_differences(expected.get(key, '<missing>'), actual.get(key, '<missing>'), f"{path}.{key}" if path else key)
+    elif isinstance(expected, list) and isinstance(actual, list):
+        for i in range(max(len(expected), len(actual))):
+            yield from find_differences(expected[i] if i < len(expected) else '<missing>', actual[i] if i < len(actual) else '<missing>', f"{path}[{i}]")
+    elif expected != actual or type(expected) is not type(actual):
+        yield path, expected, actual
+
+#Paths of the template placeholders such as '$value' left in a bundle because no cell replaced them
+def find_placeholders(value, path = ""):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from find_placeholders(item, f"{path}.{key}" if path else key)
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            yield from find_placeholders(item, f"{path}[{i}]")
+    elif isinstance(value, str) and re.match(r'\$[A-Za-z]', value):
+        yield path, value
+
+#Path parts without indexes or qualifiers: 'identifier[0].value' and 'Patient.identifier[system=NPI].value' both give
+#['identifier', 'value'] once the resourceType is dropped
+def path_parts(json_path, resource_type = None):
+    parts = [re.sub(r'\[.*?\]', '', part) for part in json_path.split('.')]
+    parts = [part for part in parts if part and part != '$']
+    if parts and parts[0] == resource_type:
+        parts = parts[1:]
+    return parts
+
+# Blames each difference on the PatientData columns whose jsonpath shares the longest leading parts with the differing
+# path in the same entity. Special value handlers and resource links write paths no column names, so a difference
+# matching no column at all is reported against the entity.
+class ColumnAttribution:
+    def __init__(self, data):
+        self.entity_names = [definition['Entity Name'] for definition in data['resource_definition_entities']]
+        self.columns = {}
+        for definition in data['resource_definition_entities']:
+            resource_type = definition['ResourceType'].strip()
+            fields = data['patient_data_entities'].get(definition['Entity Name'], {})
+            self.columns[definition['Entity Name']] = [(f"{definition['Entity Name']} / {field_name} ({field['jsonpath']})", path_parts(field['jsonpath'] or '', resource_type))
+                                                       for field_name, field in fields.items()]
+
+    def columns_for(self, difference_path):
+        match = re.match(r'entry\[(\d+)\]\.resource\.?(.*)', difference_path)
+        if match is None or int(match.group(1)) >= len(self.entity_names):
+            return ["(bundle)"]
+        entity_name = self.entity_names[int(match.group(1))]
+        parts = path_parts(match.group(2))
+        best_length, best_columns = 0, []
+        for label, column_parts in self.columns[entity_name]:
+            length = 0
+            while length < min(len(parts), len(column_parts)) and parts[length] == column_parts[length]:
+                length += 1
+            if length > best_length:
+                best_length, best_columns = length, [label]
+            elif length == best_length and length > 0:
+                best_columns.append(label)
+        return best_columns or [f"{entity_name} / (no matching column: {'.'.join(parts) or 'resource'})"]
+
+#Build every patient of one workbook with every engine and compare them with golden, {patient index: bundle}, or with the
+#reference engine when golden is None. Returns the number of patients, the time of the reference engine,
+#{engine: {'seconds', 'mismatched_bundles', 'columns'}}, the placeholders found in the reference bundles as
+#(row, path, value), the golden patients missing from the workbook and the reference bundles as (patient index, bundle)
+def check_workbook(input_file, engine_functions, max_rows = None, golden = None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        data = read_input.read_xlsx_and_process(input_file, rows=(0, max_rows - 1) if max_rows else None)
+    attribution = ColumnAttribution(data)
+    results = {name: {'seconds': 0.0, 'mismatched_bundles': 0, 'columns': {}} for name in engine_functions if name != 'reference' or golden is not None}
+    reference_seconds = 0.0
+    placeholders = []
+    reference_bundles = []
+    for index in range(data['num_entries']):
+        row_index = data['row_indexes'][index]
+        seed = f"{Path(input_file).name}:{row_index}"
+        with deterministic_ids(seed), contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            reference_bundle = number_ids(normalize(engine_functions['reference'](data, index)))
+            reference_seconds += time.perf_counter() - start
+        reference_bundles.append((row_index, reference_bundle))
+        placeholders.extend((row_index, path, value) for path, value in find_placeholders(reference_bundle))
+        expected = golden.get(row_index, '<missing>') if golden is not None else reference_bundle
+        for name, result in results.items():
+            if name == 'reference':
+                actual = reference_bundle
+            else:
+                with deterministic_ids(seed), contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    actual = number_ids(normalize(engine_functions[name](data, index)))
+                    result['seconds'] += time.perf_counter() - start
+            differences = list(find_differences(expected, actual))
+            if differences:
+                result['mismatched_bundles'] += 1
+            for difference in differences:
+                for column in attribution.columns_for(difference[0]):
+                    column_result = result['columns'].setdefault(column, {'count': 0, 'example': difference})
+                    column_result['count'] += 1
+    if 'reference' in results:
+        results['reference']['seconds'] = reference_seconds
+    missing = sorted(row_index for row_index in golden or {} if row_index not in data['row_indexes'] and (not max_rows or row_index < max_rows))
+    return data['num_entries'], reference_seconds, results, placeholders, missing, reference_bundles
+
+#Row ranges and shards read by check_row_filter, as (rows, shard)
+row_filter_cases = [((1, None), None), ((2, 5), None), (None, (1, 2)), (None, (2, 3)), ((1, 6), (2, 2))]
+
+#Read the requested rows of a workbook with the sheet xml filtered by read_input.skip_unrequested_rows and with the regular
+#parse it falls back to, which relies on no private openpyxl api. Returns the (rows, shard) cases whose reads differ
+def check_row_filter(input_file, cases = row_filter_cases):
+    mismatched = []
+    for rows, shard in cases:
+        reads = []
+        for filter_sheet_xml in (True, False):
+            read_input.filter_sheet_xml = filter_sheet_xml
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    reads.append(read_input.read_xlsx_and_process(input_file, rows, shard))
+            finally:
+                read_input.filter_sheet_xml = True
+        if reads[0] != reads[1]:
+            mismatched.append((rows, shard))
+    return mismatched
+
+#repr of a json value, cut short for the report
+def shorten(value, length = 80):
+    text = repr(value)
+    return text if len(text) <= length else text[:length] + '...'
+
+def main(input_files, engine_names, candidates, max_rows, max_columns, update_golden = False):
+    engine_functions = {'reference': engines['reference']}
+    engine_functions.update((name, engines[name]) for name in engine_names if name != 'reference')
+    engine_functions.update((spec, load_engine(spec)) for spec in candidates)
+    failed = False
+    for input_file in input_files:
+        golden = None if update_golden else read_golden(input_file)
+        bundle_count, reference_seconds, results, placeholders, missing, reference_bundles = check_workbook(input_file, engine_functions, max_rows, golden)
+        compared_with = "golden snapshot" if golden is not None else "reference engine, no golden snapshot"
+        print(f"{Path(input_file).name}: {bundle_count} patients, reference {reference_seconds * 1000:.0f}ms, compared with the {compared_with}")
+        if update_golden:
+            print(f"    wrote {write_golden(input_file, reference_bundles)}")
+        if missing:
+            print(f"    {len(missing)} patients of the golden snapshot have no row in the workbook, e.g. {missing[0]}")
+            failed = True
+        if placeholders:
+            row_index, path, value = placeholders[0]
+            print(f"    {len(placeholders)} template placeholders left in the bundles, e.g. row {row_index} {path}: {value!r}")
+            failed = True
+        for name, result in results.items():
+            outcome = "identical" if not result['mismatched_bundles'] else f"{result['mismatched_bundles']} bundles differ"
+            print(f"    {name:<12} {result['seconds'] * 1000:8.0f}ms  {outcome}")
+            ranked = sorted(result['columns'].items(), key=lambda item: -item[1]['count'])
+            for column, column_result in ranked[:max_columns]:
+                path, expected, actual = column_result['example']
+                print(f"        {column_result['count']:6d}  {column}  e.g. {path}: expected {shorten(expected)}, got {shorten(actual)}")
+            if len(ranked) > max_columns:
+                print(f"        ... and {len(ranked) - max_columns} more columns")
+            failed = failed or bool(result['mismatched_bundles'])
+        mismatched_reads = check_row_filter(input_file)
+        if mismatched_reads:
+            rows, shard = mismatched_reads[0]
+            print(f"    row filter   {len(mismatched_reads)} reads differ from the unfiltered parse, e.g. rows {rows} shard {shard}")
+            failed = True
+        else:
+            print(f"    row filter   {len(row_filter_cases)} reads identical to the unfiltered parse")
+    print("FAIL: engines differ from the expected bundles, left placeholders or the row filter changed the rows read" if failed else "All engines match the expected bundles")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build every patient of the templates with each bundle engine and compare them with the golden snapshots.")
+    parser.add_argument('--input_files', type=str, nargs='+', help="Workbooks to check", default=sorted(str(path) for path in (Path(__file__).resolve().parent / 'resources').glob('*.xlsx')) + sorted(str(path) for path in golden_folder.glob('*.xlsx')))
+    parser.add_argument('--engines', type=str, nargs='+', choices=list(engines), help="Built in engines to compare with the reference", default=[name for name in engines if name != 'reference'])
+    parser.add_argument('--candidate', type=str, action='append', help="Extra engine to compare, as module:function taking (data, index) and returning a bundle dict or json bytes", default=[])
+    parser.add_argument('--max_rows', type=int, help="Only check the first rows of each workbook", default=None)
+    parser.add_argument('--max_columns', type=int, help="Number of mismatching columns to list per engine", default=10)
+    parser.add_argument('--update_golden', action='store_true', help="Write the reference engine's bundles as the golden snapshot of every workbook instead of comparing with it; review the diff before committing")
+    args = parser.parse_args()
+    if args.update_golden and args.max_rows:
+        parser.error("--update_golden writes every patient of a workbook and can not be combined with --max_rows")
+    sys.exit(main(args.input_files, args.engines, args.candidate, args.max_rows, args.max_columns, args.update_golden))
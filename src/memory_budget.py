@@ -0,0 +1,219 @@
+import gc
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import orjson
+
+size_units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+#Parse a memory size such as 512M, 2G, 1.5GB or a plain number of bytes
+def parse_memory_size(size_string):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*', (size_string or '').lower())
+    if match is None:
+        raise ValueError(f"Memory size '{size_string}' is expected to look like '512M', '2G' or a number of bytes")
+    return int(float(match.group(1)) * size_units[match.group(2)])
+
+#Peak resident set size of this process in bytes, or None where it can not be read (Windows)
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+#Current resident set size in bytes. Without /proc the peak is the closest available figure, which only errs on the safe side
+def current_rss_bytes():
+    try:
+        with open('/proc/self/statm', 'rb') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_bytes()
+
+# Keeps a run near max_bytes of resident memory and records where the memory went. Work is split into named phases; each
+# records its time and the peak RSS sampled every sample_interval_seconds by a background thread while it ran. With
+# trace_allocations it also records the peak of Python allocations traced by tracemalloc and, for the run whose traced
+# allocations grew the most above what was allocated when it started, the source lines whose allocations grew the most between entering and leaving the phase; tracing slows reading and
+# converting several times over, so it is only meant for finding what to trim. Phases may nest, an outer phase then
+# includes its nested phases. Work done on other threads, such as writing files, is recorded with record_background.
+# Without max_bytes or trace_allocations every method is a no-op.
+class MemoryBudget:
+    #Share of the budget that built but not yet written bundles may take
+    pending_share = 8
+    #Share of the budget that one batch of PatientData cell values may take, and the rough size of one cell value
+    batch_share = 4
+    bytes_per_cell = 200
+    #Pressure is relieved at most this often, as freed memory is not always handed back to the system right away
+    relief_interval_seconds = 1.0
+    #How often the resident memory of the running phases is sampled
+    sample_interval_seconds = 0.05
+
+    def __init__(self, max_bytes = None, trace_allocations = False, top_allocators = 10):
+        self.max_bytes = max_bytes
+        self.limited = max_bytes is not None
+        self.enabled = self.limited or trace_allocations
+        self.tracing = trace_allocations
+        self.soft_limit = int(max_bytes * 0.9) if self.limited else None
+        self.top_allocators = top_allocators
+        self.phases = {}
+        #(name, tracemalloc snapshot and traced size on entering) of every running phase, innermost last
+        self.phase_stack = []
+        self.background = {}
+        self.lock = threading.Lock()
+        self.caches = {}
+        self.pressure_events = 0
+        self.last_relief = 0.0
+        self.warned_over_budget = False
+        self.started = time.perf_counter()
+        self.started_tracing = False
+        if self.tracing and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        self.stop_sampling = threading.Event()
+        self.sampler = None
+        if self.enabled:
+            self.sampler = threading.Thread(target=self.sample_while_running, name="memory-sampler", daemon=True)
+            self.sampler.start()
+
+    #Largest total size of bundles waiting to be written
+    @property
+    def max_pending_bytes(self):
+        return self.max_bytes // self.pending_share if self.limited else None
+
+    #Number of patient rows to read per batch, given the number of PatientData columns; None reads them all at once
+    def batch_rows(self, column_count):
+        if not self.limited:
+            return None
+        return max(1, min(10000, self.max_bytes // self.batch_share // (max(column_count, 1) * self.bytes_per_cell)))
+
+    #Register a cache to be emptied when memory runs short
+    def register_cache(self, name, clear):
+        if self.enabled:
+            self.caches[name] = clear
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.phase_stack:
+            self.record_traced_peak(*self.phase_stack[-1])
+        stats = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_rss_bytes': 0, 'traced_peak_bytes': None, 'traced_growth_bytes': None,
+                                              'top_allocators': []})
+        with self.lock:
+            self.phase_stack.append((name, self.take_snapshot(), tracemalloc.get_traced_memory()[0] if self.tracing else None))
+        self.reset_traced_peak()
+        self.sample()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats['calls'] += 1
+            stats['seconds'] += time.perf_counter() - start
+            self.sample()
+            self.record_traced_peak(*self.phase_stack[-1])
+            with self.lock:
+                self.phase_stack.pop()
+            self.reset_traced_peak()
+
+    def reset_traced_peak(self):
+        if self.tracing:
+            tracemalloc.reset_peak()
+
+    def take_snapshot(self):
+        if not self.tracing:
+            return None
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)))
+
+    def record_traced_peak(self, name, start_snapshot, start_traced):
+        if not self.tracing:
+            return
+        stats = self.phases[name]
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        stats['traced_peak_bytes'] = max(stats['traced_peak_bytes'] or 0, traced_peak)
+        if stats['traced_growth_bytes'] is None or traced_peak - start_traced > stats['traced_growth_bytes']:
+            stats['traced_growth_bytes'] = traced_peak - start_traced
+            stats['top_allocators'] = self.top_allocations(start_snapshot)
+
+    #Source lines whose traced allocations grew the most since start_snapshot, leaving out what was allocated before the phase
+    def top_allocations(self, start_snapshot):
+        grown = sorted((stat for stat in self.take_snapshot().compare_to(start_snapshot, 'lineno') if stat.size_diff > 0), key=lambda stat: -stat.size_diff)
+        return [{'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", 'size_diff_bytes': stat.size_diff, 'count_diff': stat.count_diff}
+                for stat in grown[:self.top_allocators]]
+
+    #Record the current RSS against the running phases
+    def sample(self):
+        rss = current_rss_bytes()
+        if rss is not None:
+            with self.lock:
+                for name, *_ in self.phase_stack:
+                    self.phases[name]['peak_rss_bytes'] = max(self.phases[name]['peak_rss_bytes'], rss)
+        return rss
+
+    def sample_while_running(self):
+        while not self.stop_sampling.wait(self.sample_interval_seconds):
+            self.sample()
+
+    #Record seconds of work done on other threads under name, such as the writer threads writing files while bundles are built
+    def record_background(self, name, seconds):
+        if self.enabled:
+            self.background[name] = self.background.get(name, 0.0) + seconds
+
+    #Called between bundles: once RSS nears the budget, wait for queued bundles to be written, empty the registered caches
+    #and collect garbage before building more
+    def relieve_pressure(self, bundle_writer = None):
+        if not self.limited:
+            return
+        rss = self.sample()
+        if rss is None or rss < self.soft_limit or time.perf_counter() - self.last_relief < self.relief_interval_seconds:
+            return
+        self.pressure_events += 1
+        if bundle_writer is not None:
+            bundle_writer.wait_until_written()
+        for clear in self.caches.values():
+            clear()
+        gc.collect()
+        self.last_relief = time.perf_counter()
+        rss = current_rss_bytes()
+        if rss is not None and rss > self.max_bytes and not self.warned_over_budget:
+            self.warned_over_budget = True
+            print(f"WARNING: - Memory Budget - resident memory is {rss / 1024 ** 2:.0f}MB after writing every queued bundle, over the budget of {self.max_bytes / 1024 ** 2:.0f}MB")
+
+    def report(self):
+        return {
+            'max_memory_bytes': self.max_bytes,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'seconds': time.perf_counter() - self.started,
+            'pressure_events': self.pressure_events,
+            'phases': [dict(name=name, **stats) for name, stats in self.phases.items()],
+            'background_seconds': self.background
+        }
+
+    #Write the report as json, merged with details of the run, and print a summary
+    def write_report(self, report_path, run_details):
+        report = dict(run_details, **self.report())
+        with open(report_path, 'wb') as report_file:
+            report_file.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+        peak = report['peak_rss_bytes']
+        budget = f"Memory budget {self.max_bytes / 1024 ** 2:.0f}MB" if self.limited else "No memory budget"
+        print(f"{budget}: peak RSS {peak / 1024 ** 2 if peak else 0:.0f}MB, {self.pressure_events} pressure events, report written to {report_path}")
+        for phase in report['phases']:
+            traced = f"  traced peak {phase['traced_peak_bytes'] / 1024 ** 2:7.0f}MB" if self.tracing else ""
+            print(f"    {phase['name']:<10} {phase['seconds']:8.1f}s  peak RSS {phase['peak_rss_bytes'] / 1024 ** 2:7.0f}MB{traced}")
+        for name, seconds in report['background_seconds'].items():
+            print(f"    {name:<10} {seconds:8.1f}s  on background threads, overlapping the phases above")
+        return report
+
+    def close(self):
+        if self.sampler is not None:
+            self.stop_sampling.set()
+            self.sampler.join()
+            self.sampler = None
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
@@ -1,29 +1,77 @@
-import openpyxl
+import io
+import re
+from itertools import zip_longest
+
+#Patient data starts on this row of the PatientData sheet; rows above it describe the columns
+first_data_row = 7
+
+#Parse a "start-end" range (inclusive) of patient indexes, or a single index
+def parse_row_range(range_string):
+    match = re.fullmatch(r'\s*(\d+)\s*(?:-\s*(\d+)\s*)?', range_string or '')
+    if match is None:
+        raise ValueError(f"Range '{range_string}' is expected to look like '120-130' or '120'")
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) is not None else start
+    if end < start:
+        raise ValueError(f"Range '{range_string}' ends before it starts")
+    return start, end
 
 # Function to read the xlsx file and access specific sheets
-def read_xlsx_and_process(file_path):
-    # Load the workbook
-    workbook = openpyxl.load_workbook(file_path)
-
-    # Example of accessing specific sheets
-    if 'ResourceDefinitions' in workbook.sheetnames:
-        sheet = workbook['ResourceDefinitions']
-        resource_definition_entities = process_sheet_resource_definitions(sheet)
-
-    if 'ResourceLinks' in workbook.sheetnames:
-        sheet = workbook['ResourceLinks']
-        resource_link_entities = process_sheet_resource_links(sheet)
-
-    if 'PatientData' in workbook.sheetnames:
-        sheet = workbook['PatientData']
-        patient_data_entities, num_entries = process_sheet_patient_data(sheet, resource_definition_entities)
-    
-    return {
-        "resource_definition_entities": resource_definition_entities,
-        "resource_link_entities": resource_link_entities,
-        "patient_data_entities": patient_data_entities,
-        "num_entries": num_entries
-    }
+# rows: optional (start, end) inclusive range of patient indexes to read, counted from the first data row.
+# shard: optional (k, n) to only read the patient indexes where index % n == k - 1 (k counts from 1).
+# Only the header rows and the requested rows of PatientData are read then.
+# processes: optional number of processes parsing the PatientData rows in parallel, see parallel_row_reader
+def read_xlsx_and_process(file_path, rows=None, shard=None, processes=None):
+    batches = iter_xlsx_batches(file_path, rows, shard, processes=processes)
+    data = next(batches)
+    batches.close()
+    return data
+
+# Read the workbook in one pass, yielding the PatientData rows in batches of at most batch_rows patients so that only one
+# batch of cell values is held in memory at a time. Every batch is a dict like read_xlsx_and_process returns, sharing the
+# same definitions and links; last_row_index is only final in the last batch. With batch_rows None there is a single batch.
+# batch_rows may also be a function of the number of PatientData columns
+def iter_xlsx_batches(file_path, rows=None, shard=None, batch_rows=None, processes=None):
+    # openpyxl is the single most expensive import of the tool; only pay for it once a workbook is actually read
+    import openpyxl
+    # Load the workbook. Read-only mode streams the sheets instead of building every cell up front
+    workbook = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        # Example of accessing specific sheets
+        if 'ResourceDefinitions' in workbook.sheetnames:
+            sheet = read_only_sheet(workbook, 'ResourceDefinitions')
+            resource_definition_entities = process_sheet_resource_definitions(sheet)
+
+        if 'ResourceLinks' in workbook.sheetnames:
+            sheet = read_only_sheet(workbook, 'ResourceLinks')
+            resource_link_entities = process_sheet_resource_links(sheet)
+
+        if 'PatientData' in workbook.sheetnames:
+            sheet = read_only_sheet(workbook, 'PatientData')
+            row_reader = parallel_row_reader(file_path, processes) if processes is not None and processes > 1 else None
+            for patient_data_entities, num_entries, row_indexes, last_row_index in iter_sheet_patient_data(sheet, resource_definition_entities, rows, shard, batch_rows, row_reader):
+                yield {
+                    "resource_definition_entities": resource_definition_entities,
+                    "resource_link_entities": resource_link_entities,
+                    "patient_data_entities": patient_data_entities,
+                    "num_entries": num_entries,
+                    # Patient index (data row counted from the first data row) of each entry that was read
+                    "row_indexes": row_indexes,
+                    # Highest patient index in the sheet, including rows that were not requested
+                    "last_row_index": last_row_index,
+                    # Per entry, the fields of each entity that have a value in its row
+                    "row_fields": index_row_fields(patient_data_entities, num_entries)
+                }
+    finally:
+        workbook.close()
+
+# Sheet of a read-only workbook, read up to its last row and column. Read-only sheets otherwise stop at the size given by
+# the <dimension> tag of the sheet xml, which some writers leave stale, silently dropping the rows and columns past it.
+# Rows then only reach their own last cell, so they can be shorter than the header rows
+def read_only_sheet(workbook, sheet_name):
+    sheet = workbook[sheet_name]
+    sheet.reset_dimensions()
+    return sheet
 
 
 # Function to process the specific sheet with 'Entity Name', 'ResourceType', and 'Profile(s)'
@@ -32,7 +80,7 @@ def process_sheet_resource_definitions(sheet):
     headers = [cell.value for cell in next(sheet.iter_rows(min_row=1, max_row=1))]  # Get headers
 
     for row in sheet.iter_rows(min_row=3, values_only=True):
-        row_data = dict(zip(headers, row))  # Create a dictionary for each row
+        row_data = dict(zip_longest(headers, row))  # Create a dictionary for each row
         if all(cell is None or cell == "" for cell in row_data.values()):
             continue
         # Split 'Profile(s)' column into a list of URLs
@@ -48,7 +96,7 @@ def process_sheet_resource_links(sheet):
     resource_links = []
     headers = [cell.value for cell in next(sheet.iter_rows(min_row=1, max_row=1))]  # Get headers
     for row in sheet.iter_rows(min_row=3, values_only=True):
-        row_data = dict(zip(headers, row))  # Create a dictionary for each row
+        row_data = dict(zip_longest(headers, row))  # Create a dictionary for each row
         if all(cell is None or cell == "" for cell in row_data):
             continue
         resource_links.append(row_data)
@@ -56,11 +104,22 @@ def process_sheet_resource_links(sheet):
     return resource_links
 
 # Function to process the "PatientData" sheet
-def process_sheet_patient_data(sheet, resource_definition_entities):
+def process_sheet_patient_data(sheet, resource_definition_entities, rows=None, shard=None):
+    return next(iter_sheet_patient_data(sheet, resource_definition_entities, rows, shard))
+
+# Process the "PatientData" sheet, yielding (patient_data, num_entries, row_indexes, last_row_index) for every batch_rows patients.
+# The data rows are read by read_patient_rows, or by row_reader(sheet, rows, shard, sheet_rows, batch_rows) when one such
+# as parallel_row_reader is given
+def iter_sheet_patient_data(sheet, resource_definition_entities, rows=None, shard=None, batch_rows=None, row_reader=None):
     # Initialize the dictionary to store the processed data
     patient_data = {}
     # Extract the data from the first 6 rows (Entity To Query, JsonPath, etc.)
-    for col in sheet.iter_cols(min_row=1, max_row=6, min_col=3, values_only=True):  # Start from 3rd column
+    header_rows = [list(row) for row in sheet.iter_rows(min_row=1, max_row=first_data_row - 1, values_only=True)]
+    width = max((len(row) for row in header_rows), default=0)
+    header_rows = [row + [None] * (width - len(row)) for row in header_rows]
+    header_rows += [[None] * width] * (first_data_row - 1 - len(header_rows))
+    header_columns = list(zip(*header_rows))[2:]  # Start from 3rd column
+    for col in header_columns:
         if all(entry is None for entry in col):
             continue
         entity_name = col[0]  # The entity name comes from the first row (Entity To Query)
@@ -82,18 +141,241 @@ def process_sheet_patient_data(sheet, resource_definition_entities):
                 "valuesets": col[3], # Value Set from the fourth row
                 "values": []         # Initialize empty list for actual values
             }
-    
-    # Now process the rows starting from the 6th row (the actual data entries)
+    # Every batch gets its own 'values' lists. Resolve once per batch which list each column appends to, instead of
+    # looking up the header cells for every cell
+    def new_batch():
+        batch_data = {entity_name: {field_name: dict(field, values=[]) for field_name, field in fields.items()} for entity_name, fields in patient_data.items()}
+        column_targets = []
+        for col in header_columns:
+            entity_name = col[0]  # The entity name comes from the first row of each column
+            field_name = col[5]  # Get the Data Element for this column
+            if entity_name in batch_data and field_name in batch_data[entity_name]:
+                column_targets.append(batch_data[entity_name][field_name]["values"])
+            else:
+                column_targets.append(None)
+        return batch_data, column_targets
+    batch_data, column_targets = new_batch()
+    if callable(batch_rows):
+        batch_rows = batch_rows(len(header_columns))
+
+    # Now process the rows starting from the 7th row (the actual data entries)
+    sheet_rows = {'last_row_number': None}
     num_entries = 0
-    for row in sheet.iter_rows(min_row=7, values_only=True):  # Start from row 6 for actual data
-        if all(cell is None for cell in row):
-            continue
+    row_indexes = []
+    if row_reader is None:
+        sheet_row_values = read_patient_rows(sheet, rows, shard, sheet_rows)
+    else:
+        sheet_row_values = row_reader(sheet, rows, shard, sheet_rows, batch_rows)
+    for row_number, row in sheet_row_values:
+        if batch_rows is not None and num_entries == batch_rows:
+            yield batch_data, num_entries, row_indexes, max(sheet_rows['last_row_number'] or 0, row_number - 1) - first_data_row
+            batch_data, column_targets = new_batch()
+            num_entries = 0
+            row_indexes = []
         num_entries = num_entries + 1
-        entity_name = row[0]  # The entity name comes from the first column of each row
-        for i, value in enumerate(row[2:], start=1):  # Iterate through the values in the columns
-            entity_name = sheet.cell(row=1, column=i + 2).value
-            field_name = sheet.cell(row=6, column=i + 2).value  # Get the Data Element for this column
-            if entity_name in patient_data and field_name in patient_data[entity_name]:
+        row_indexes.append(row_number - first_data_row)
+        #A row ending before the last column still appends to every column, keeping the 'values' lists aligned
+        for values, value in zip_longest(column_targets, row[2:]):  # Iterate through the values in the columns
+            if values is not None:
                 # Append the actual data values to the 'values' array
-                patient_data[entity_name][field_name]["values"].append(value)
-    return patient_data, num_entries
\ No newline at end of file
+                values.append(value)
+    yield batch_data, num_entries, row_indexes, sheet_rows['last_row_number'] - first_data_row
+
+# Yield (row number, cells) of every requested PatientData row holding data. The number of the last row of the sheet is
+# stored in sheet_rows['last_row_number'] as soon as it is known, at the latest once every row was yielded.
+# is_requested replaces the predicate of rows and shard when given
+def read_patient_rows(sheet, rows, shard, sheet_rows, is_requested = None):
+    min_row = first_data_row + rows[0] if rows is not None else first_data_row
+    if is_requested is None:
+        is_requested = row_filter(rows, shard)
+    if is_requested is not None:
+        skip_unrequested_rows(sheet, is_requested, sheet_rows)
+    row_number = first_data_row - 1
+    # Read on past the end of the range, so that the last row of the sheet is known without trusting its dimension tag
+    for row_number, row in enumerate(sheet.iter_rows(min_row=min_row, values_only=True), start=min_row):
+        # Rows cut out of the sheet xml come back empty; this also filters the rows when the sheet could not be cut
+        if is_requested is not None and not is_requested(row_number - first_data_row):
+            continue
+        if all(cell is None for cell in row):
+            continue
+        yield row_number, row
+    if sheet_rows['last_row_number'] is None:
+        sheet_rows['last_row_number'] = max(sheet.max_row or 0, row_number)
+
+#Patient rows per block of parallel_row_reader when no batch size is given
+parallel_block_rows = 1000
+
+# Row reader parsing the PatientData rows on several processes. The requested patient indexes are cut into blocks of
+# batch_rows patients, dealt out in turn to the processes: each process streams the sheet once, filtering it down to the
+# rows of its own blocks, and sends every block as soon as it is parsed. Blocks are merged back in order and each process
+# keeps at most one block ready ahead of the merge, so about two blocks per process are held in memory at a time
+def parallel_row_reader(file_path, processes):
+    def read_rows(sheet, rows, shard, sheet_rows, batch_rows):
+        import bundle_prefetch
+        #A block spans batch_rows requested patients, which are shard_count indexes apart within a shard
+        block_rows = (batch_rows or parallel_block_rows) * (shard[1] if shard is not None else 1)
+        blocks = bundle_prefetch.in_processes(read_patient_row_blocks, (file_path, rows, shard, block_rows), processes, 1)
+        try:
+            for block, row_numbers, row_values, last_row_number in blocks:
+                if last_row_number is not None:
+                    sheet_rows['last_row_number'] = max(sheet_rows['last_row_number'] or 0, last_row_number)
+                yield from zip(row_numbers, row_values)
+        finally:
+            blocks.close()
+    return read_rows
+
+#Worker of parallel_row_reader for worker shard (k, processes): yields (block, row numbers, cells) for the requested rows
+#holding data in every block of block_rows patient indexes with block % processes == k - 1, then (inf, [], [], number of
+#the last row of the sheet) so that it sorts after every block
+def read_patient_row_blocks(file_path, rows, row_shard, block_rows, shard):
+    import math
+    import openpyxl
+    worker, processes = shard
+    start = rows[0] if rows is not None else 0
+    is_requested = row_filter(rows, row_shard)
+    def is_requested_by_worker(row_index):
+        return (row_index - start) // block_rows % processes == worker - 1 and (is_requested is None or is_requested(row_index))
+    workbook = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        sheet_rows = {'last_row_number': None}
+        block, row_numbers, row_values = None, [], []
+        for row_number, row in read_patient_rows(read_only_sheet(workbook, 'PatientData'), rows, row_shard, sheet_rows, is_requested_by_worker):
+            row_block = (row_number - first_data_row - start) // block_rows
+            if row_block != block and row_numbers:
+                yield block, row_numbers, row_values, None
+                row_numbers, row_values = [], []
+            block = row_block
+            row_numbers.append(row_number)
+            row_values.append(row)
+        if row_numbers:
+            yield block, row_numbers, row_values, None
+        yield math.inf, [], [], sheet_rows['last_row_number']
+    finally:
+        workbook.close()
+
+# Sparse index of the cells that hold a value: for every entry, {entity name: [field, ...]} in column order, leaving out
+# fields whose cell is empty. Wide templates mostly hold empty cells, so building a resource from this index costs what
+# the row holds rather than the width of the template. Empty strings are kept, as they are values.
+def index_row_fields(patient_data, num_entries):
+    row_fields = [{} for _ in range(num_entries)]
+    for entity_name, fields in patient_data.items():
+        for field in fields.values():
+            for index, value in enumerate(field['values'][:num_entries]):
+                if value is not None:
+                    row_fields[index].setdefault(entity_name, []).append(field)
+    return row_fields
+
+#Predicate telling whether a patient index was requested, or None when every row is
+def row_filter(rows=None, shard=None):
+    if rows is None and shard is None:
+        return None
+    start, end = rows if rows is not None else (0, None)
+    shard_remainder, shard_count = (shard[0] - 1, shard[1]) if shard is not None else (0, 1)
+    def is_requested(row_index):
+        return start <= row_index and (end is None or row_index <= end) and row_index % shard_count == shard_remainder
+    return is_requested
+
+#openpyxl versions whose read-only sheets read their xml through the private ReadOnlyWorksheet._get_source(), which
+#skip_unrequested_rows replaces; other versions fall back to the regular parse
+filterable_openpyxl_versions = ((3, 0), (3, 2))
+#Set to False to always take the regular parse; golden_harness checks both give the same rows
+filter_sheet_xml = True
+
+#openpyxl fully parses every row before min_row even when they are not returned. Filter the sheet xml down to the
+#header rows and the requested rows as openpyxl streams it, so skipping a row costs a byte scan instead. The number of
+#the last row of the sheet is stored in sheet_rows['last_row_number'] once the filter reaches the end of the rows.
+#Returns False, leaving the regular (slower) parse, when the sheet is not a read-only sheet of a known openpyxl version
+def skip_unrequested_rows(sheet, is_requested, sheet_rows):
+    import openpyxl
+    version = tuple(int(part) for part in re.findall(r'\d+', openpyxl.__version__)[:2])
+    if not filter_sheet_xml or not filterable_openpyxl_versions[0] <= version < filterable_openpyxl_versions[1] or not callable(getattr(sheet, '_get_source', None)):
+        return False
+    get_source = sheet._get_source
+    sheet._get_source = lambda: RowFilteringReader(get_source(), is_requested, sheet_rows)
+    return True
+
+# Read-only stream of a sheet's xml leaving out the <row> elements of unrequested patient rows, holding no more than a
+# chunk of the sheet at a time. Everything outside sheetData, and the header rows, is passed through unchanged. A row
+# without an r attribute is given its number, since openpyxl would otherwise number it after the last row it saw.
+class RowFilteringReader(io.RawIOBase):
+    row_or_rows_end = re.compile(rb'<((?:\w+:)?row)[\s>/]|</(?:\w+:)?sheetData>')
+    row_number_attribute = re.compile(rb'\sr="(\d+)"')
+
+    def __init__(self, source, is_requested, sheet_rows, chunk_size = 1 << 16):
+        self.source = source
+        self.is_requested = is_requested
+        self.sheet_rows = sheet_rows
+        self.chunk_size = chunk_size
+        #Bytes read from the source and not filtered yet, and filtered bytes from output_position on not handed out yet
+        self.pending = b''
+        self.output = b''
+        self.output_position = 0
+        #Whether the bytes of the current row are kept, and the number of that row
+        self.keeping = True
+        self.row_number = 0
+        self.rows_ended = False
+        self.source_ended = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.output_position == len(self.output) and not (self.source_ended and not self.pending):
+            self.filter_chunk()
+        size = min(len(buffer), len(self.output) - self.output_position)
+        buffer[:size] = memoryview(self.output)[self.output_position:self.output_position + size]
+        self.output_position += size
+        return size
+
+    def filter_chunk(self):
+        data = self.source.read(self.chunk_size)
+        self.source_ended = not data
+        pending = self.pending + data
+        kept = []
+        position = 0
+        while position < len(pending):
+            if self.rows_ended:
+                kept.append(pending[position:])
+                position = len(pending)
+                break
+            match = self.row_or_rows_end.search(pending, position)
+            if match is None:
+                #A tag cut in two by the end of the chunk is only filtered once the rest of it was read
+                cut = pending.rfind(b'<', position) if not self.source_ended else -1
+                cut = len(pending) if cut == -1 else cut
+                if self.keeping:
+                    kept.append(pending[position:cut])
+                position = cut
+                break
+            if self.keeping:
+                kept.append(pending[position:match.start()])
+            position = match.start()
+            if match.group(1) is None:
+                self.rows_ended = True
+                self.keeping = True
+                self.sheet_rows['last_row_number'] = self.row_number
+                continue
+            tag_end = pending.find(b'>', match.start())
+            if tag_end == -1 and not self.source_ended:
+                break
+            tag_end = len(pending) - 1 if tag_end == -1 else tag_end
+            tag = pending[match.start():tag_end + 1]
+            row_number = self.row_number_attribute.search(tag)
+            if row_number is not None:
+                self.row_number = int(row_number.group(1))
+            else:
+                self.row_number += 1
+                name_end = len(match.group(1)) + 1
+                tag = tag[:name_end] + b' r="%d"' % self.row_number + tag[name_end:]
+            self.keeping = self.row_number < first_data_row or self.is_requested(self.row_number - first_data_row)
+            if self.keeping:
+                kept.append(tag)
+            position = tag_end + 1
+        self.pending = pending[position:]
+        self.output = self.output[self.output_position:] + b''.join(kept)
+        self.output_position = 0
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super().close()
@@ -0,0 +1,123 @@
+import re
+from datetime import date, datetime, time
+from pathlib import Path
+import orjson
+
+json_templates_folder = Path(__file__).resolve().parent / 'resources' / 'json_templates'
+
+#Python types a built bundle may hold; orjson renders the date and time types as strings
+allowed_scalar_types = (str, bool, int, float, type(None), datetime, date, time)
+
+#Called by orjson for any value it cannot encode natively; these are structures leaking out of the build step
+#such as placeholder sets in custom handler templates
+def reject_unexpected_type(obj):
+    raise TypeError(f"unexpected {type(obj).__name__}")
+
+#Serialize a bundle dict to compact json bytes, optionally checking every resource against a compiled schema first
+def dumps(bundle, schema = None):
+    if schema is not None:
+        for entry in bundle.get('entry', []):
+            check_resource_schema(entry.get('resource'), schema)
+    return encode(bundle)
+
+#Encode with orjson; the walk to locate an unexpected value only happens once orjson has already failed
+def encode(obj, path = ""):
+    try:
+        return orjson.dumps(obj, default=reject_unexpected_type)
+    except orjson.JSONEncodeError as e:
+        found = find_unexpected_types(obj, path)
+        if not found:
+            raise TypeError(f"ERROR: - Serializing Bundle - {path} - {e}") from None
+        details = "; ".join(f"{type_name} found at path: {found_path}" for found_path, type_name in found)
+        raise TypeError(f"ERROR: - Serializing Bundle - {details}") from None
+
+#Collect the paths of every value that is not plain json
+def find_unexpected_types(d, path = ""):
+    found = []
+    if isinstance(d, dict):
+        for key, value in d.items():
+            new_path = f"{path}.{key}" if path else str(key)
+            if not isinstance(key, str):
+                found.append((new_path, f"{type(key).__name__} key"))
+            found.extend(find_unexpected_types(value, new_path))
+    elif isinstance(d, list):
+        for idx, item in enumerate(d):
+            found.extend(find_unexpected_types(item, f"{path}[{idx}]"))
+    elif not isinstance(d, allowed_scalar_types):
+        found.append((path, type(d).__name__))
+    return found
+
+#Compile the json templates into a schema of expected json types per resourceType.
+#Placeholders such as "${Date of Birth}" and bare ${Deceased Indicator} only fix the shape around them, not their own type
+def compile_bundle_schema(template_folder = json_templates_folder):
+    schema = {}
+    for template_path in sorted(Path(template_folder).glob('*.json')):
+        template_text = re.sub(r'(?<!")\$\{[^}]*\}(?!")', 'null', template_path.read_text())
+        try:
+            template = orjson.loads(template_text)
+        except orjson.JSONDecodeError as e:
+            print(f"WARNING: - Compiling Schema - {template_path.name} - could not be parsed and is ignored: {e}")
+            continue
+        #Templates are either a bundle, or a single entry of a bundle
+        entries = template.get('entry', []) if template.get('resourceType') == 'Bundle' else [template]
+        for entry in entries:
+            resource = entry.get('resource') if isinstance(entry, dict) else None
+            if isinstance(resource, dict) and isinstance(resource.get('resourceType'), str):
+                resource_type = resource['resourceType']
+                schema[resource_type] = merge_schema_node(schema.get(resource_type), resource)
+    return schema
+
+#A schema node is {'types': set of json type names, 'keys': {key: node}, 'items': node or None}
+def merge_schema_node(node, value):
+    if node is None:
+        node = {'types': set(), 'keys': {}, 'items': None}
+    if isinstance(value, str) and re.fullmatch(r'\$\{[^}]*\}', value) or value is None:
+        return node
+    node['types'].add(json_type_name(value))
+    if isinstance(value, dict):
+        for key, inner_value in value.items():
+            node['keys'][key] = merge_schema_node(node['keys'].get(key), inner_value)
+    elif isinstance(value, list):
+        for item in value:
+            node['items'] = merge_schema_node(node['items'], item)
+    return node
+
+def json_type_name(value):
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, list):
+        return 'array'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, (str, datetime, date, time)):
+        return 'string'
+    return type(value).__name__
+
+#Check a resource against the schema of its resourceType. Only keys known to the schema are visited, so the cost
+#is bounded by the size of the templates rather than the size of the bundle
+def check_resource_schema(fhir_resource, schema):
+    if not isinstance(fhir_resource, dict):
+        return []
+    node = schema.get(fhir_resource.get('resourceType'))
+    if node is None:
+        return []
+    issues = []
+    check_schema_node(fhir_resource, node, fhir_resource['resourceType'], issues)
+    for path, expected, found in issues:
+        print(f"WARNING: - Schema Check - {fhir_resource['resourceType']}/{fhir_resource.get('id')} - {path} - expected {' or '.join(sorted(expected))} but found {found}")
+    return issues
+
+def check_schema_node(value, node, path, issues):
+    found = json_type_name(value)
+    if node['types'] and found not in node['types']:
+        issues.append((path, node['types'], found))
+        return
+    if isinstance(value, dict):
+        for key, inner_node in node['keys'].items():
+            if key in value:
+                check_schema_node(value[key], inner_node, f"{path}.{key}", issues)
+    elif isinstance(value, list) and node['items'] is not None:
+        for idx, item in enumerate(value):
+            check_schema_node(item, node['items'], f"{path}[{idx}]", issues)
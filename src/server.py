@@ -0,0 +1,140 @@
+import read_input
+import conversion
+import serialization
+
+import argparse
+import os
+import re
+import socketserver
+import threading
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+# Keeps a workbook read and recently built bundles cached, reloading everything
+# when the xlsx changes on disk
+class WarmCohort:
+    def __init__(self, input_file, cache_size = 1024):
+        self.input_file = Path(input_file)
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.loaded_stat = None
+        self.reload_if_changed()
+
+    def file_stat(self):
+        stat = os.stat(self.input_file)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def reload_if_changed(self):
+        current_stat = self.file_stat()
+        if current_stat == self.loaded_stat:
+            return
+        with self.lock:
+            if current_stat == self.loaded_stat:
+                return
+            print(f"Loading workbook {self.input_file}")
+            data = read_input.read_xlsx_and_process(self.input_file)
+            #Position of each patient index within the data that was read
+            positions = {row_index: position for position, row_index in enumerate(data['row_indexes'])}
+            #Swapped in one assignment so a request never mixes the old workbook with the new one
+            self.state = (data, positions, OrderedDict())
+            self.loaded_stat = current_stat
+
+    #Rendered bundle for the patient at index; the same index keeps returning the same bundle until the workbook changes
+    def patient_bundle(self, index):
+        self.reload_if_changed()
+        data, positions, bundle_cache = self.state
+        if index not in positions:
+            raise IndexError(f"Patient index {index} has no data; the workbook has {data['num_entries']} patients")
+        with self.lock:
+            json_bytes = bundle_cache.get(index)
+            if json_bytes is not None:
+                bundle_cache.move_to_end(index)
+                return json_bytes
+        fhir_bundle = conversion.create_transaction_bundle(data['resource_definition_entities'], data['resource_link_entities'],
+                                                           data['patient_data_entities'], positions[index], data['row_fields'][positions[index]])
+        json_bytes = serialization.dumps(fhir_bundle)
+        if self.cache_size > 0:
+            with self.lock:
+                bundle_cache[index] = json_bytes
+                while len(bundle_cache) > self.cache_size:
+                    bundle_cache.popitem(last=False)
+        return json_bytes
+
+class CohortRequestHandler(BaseHTTPRequestHandler):
+    cohort = None
+    #Most bundles one /bundles request may ask for; every one of them is built and held in memory before the reply is sent
+    max_range = 1000
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            patient_match = re.fullmatch(r'/patients/(\d+)', url.path)
+            if patient_match:
+                return self.send_json(200, self.cohort.patient_bundle(int(patient_match.group(1))))
+            if url.path == '/bundles':
+                start, end = read_input.parse_row_range(parse_qs(url.query).get('range', [''])[0])
+                if end - start + 1 > self.max_range:
+                    return self.send_error_json(400, f"Range {start}-{end} asks for {end - start + 1} bundles; at most {self.max_range} are served per request")
+                return self.send_json(200, b'[' + b','.join(self.cohort.patient_bundle(i) for i in range(start, end + 1)) + b']')
+            if url.path == '/health':
+                self.cohort.reload_if_changed()
+                return self.send_json(200, serialization.encode({'input_file': str(self.cohort.input_file), 'patients': self.cohort.state[0]['num_entries']}))
+            return self.send_error_json(404, f"Unknown path {url.path}; expected /patients/{{i}} or /bundles?range=start-end")
+        except IndexError as e:
+            return self.send_error_json(404, str(e))
+        except ValueError as e:
+            return self.send_error_json(400, str(e))
+        #Anything else, e.g. a workbook that fails to reload, still gets a json reply; the traceback goes to the server log
+        except Exception as e:
+            self.log_error("%s", traceback.format_exc())
+            return self.send_error_json(500, f"{type(e).__name__}: {e}")
+
+    def send_json(self, status, json_bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(json_bytes)))
+        self.end_headers()
+        self.wfile.write(json_bytes)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, serialization.encode({'error': message}))
+
+    #Unix socket clients have no address to log
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else 'unix'
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(input_file, host = '127.0.0.1', port = 8080, socket_path = None, cache_size = 1024, max_range = 1000):
+    handler = type('BoundCohortRequestHandler', (CohortRequestHandler,), {'cohort': WarmCohort(input_file, cache_size), 'max_range': max_range})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = ThreadingUnixHTTPServer(socket_path, handler)
+        print(f"Serving {input_file} on unix socket {socket_path}")
+    else:
+        httpd = ThreadingHTTPServer((host, port), handler)
+        print(f"Serving {input_file} on http://{host}:{httpd.server_address[1]}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve patient bundles from a workbook that is read once and kept warm.")
+    parser.add_argument('--input_file', type=str, help="Path to the input xlsx ", default="resources/Synthetic_Input_Baseline.xlsx")
+    parser.add_argument('--host', type=str, help="Host to listen on", default="127.0.0.1")
+    parser.add_argument('--port', type=int, help="Port to listen on", default=8080)
+    parser.add_argument('--socket', type=str, help="Listen on this unix socket path instead of a tcp port", default=None)
+    parser.add_argument('--cache_size', type=int, help="Number of rendered bundles to keep in memory", default=1024)
+    parser.add_argument('--max_range', type=int, help="Most bundles a single /bundles?range= request may ask for", default=1000)
+    args = parser.parse_args()
+    serve(args.input_file, args.host, args.port, args.socket, args.cache_size, args.max_range)
@@ -0,0 +1,144 @@
+import read_input
+
+import argparse
+import hashlib
+import re
+import sys
+from pathlib import Path
+import orjson
+
+#Parse "K/N": generate shard K (counting from 1) of N. Patient index i belongs to shard (i % N) + 1
+def parse_shard(shard_string):
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', shard_string or '')
+    if match is None:
+        raise ValueError(f"Shard '{shard_string}' is expected to look like '2/8' (shard 2 of 8)")
+    shard, shard_count = int(match.group(1)), int(match.group(2))
+    if shard_count < 1 or not 1 <= shard <= shard_count:
+        raise ValueError(f"Shard '{shard_string}' has to be between 1/{max(shard_count, 1)} and {max(shard_count, 1)}/{max(shard_count, 1)}")
+    return shard, shard_count
+
+def manifest_file_name(shard):
+    return f"manifest-{shard[0]}-of-{shard[1]}.json"
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+#Record what one shard generated: the patient indexes written, the indexes assigned to it that had no data, and the files.
+#Together the manifests of every shard account for each index of the sheet exactly once
+def write_shard_manifest(output_folder, input_file, shard, data, files, rows = None):
+    is_requested = read_input.row_filter(rows, shard)
+    generated = set(data['row_indexes'])
+    empty_rows = [i for i in range(shard[0] - 1, data['last_row_index'] + 1, shard[1]) if i not in generated and is_requested(i)]
+    manifest = {
+        'input_file': Path(input_file).name,
+        'input_sha256': file_sha256(input_file),
+        'shard': shard[0],
+        'shard_count': shard[1],
+        'requested_rows': list(rows) if rows is not None else None,
+        'last_row_index': data['last_row_index'],
+        'rows': data['row_indexes'],
+        'empty_rows': empty_rows,
+        'files': files
+    }
+    manifest_path = Path(output_folder) / manifest_file_name(shard)
+    manifest_path.write_bytes(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+    return manifest_path
+
+#Manifest files given directly, or found in the output folders given
+def find_manifests(paths):
+    manifest_paths = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            manifest_paths.extend(sorted(path.glob('manifest-*-of-*.json')))
+        else:
+            manifest_paths.append(path)
+    return manifest_paths
+
+def read_manifest(manifest_path):
+    try:
+        return orjson.loads(manifest_path.read_bytes())
+    except (OSError, orjson.JSONDecodeError) as e:
+        raise ValueError(f"ERROR: - Merging Shards - can not read the manifest {manifest_path}: {e}") from e
+
+#Combine the manifests of every shard, checking they come from the same workbook and cover every patient index once
+def merge_manifests(paths):
+    manifest_paths = find_manifests(paths)
+    if not manifest_paths:
+        raise ValueError(f"ERROR: - Merging Shards - no shard manifests found in {', '.join(map(str, paths))}")
+    manifests = [(manifest_path, read_manifest(manifest_path)) for manifest_path in manifest_paths]
+    first = manifests[0][1]
+    shard_count = first['shard_count']
+    problems = []
+    shards_seen = {}
+    row_owners = {}
+    duplicate_rows = []
+    misplaced_rows = []
+    merged_files = []
+    for manifest_path, manifest in manifests:
+        for key in ('input_sha256', 'shard_count', 'last_row_index'):
+            if manifest[key] != first[key]:
+                problems.append(f"{manifest_path} has {key} {manifest[key]} but {manifest_paths[0]} has {first[key]}")
+        shard = manifest['shard']
+        if shard in shards_seen:
+            problems.append(f"shard {shard} is in both {shards_seen[shard]} and {manifest_path}")
+            continue
+        shards_seen[shard] = manifest_path
+        if manifest['requested_rows'] is not None:
+            problems.append(f"{manifest_path} only generated rows {manifest['requested_rows'][0]}-{manifest['requested_rows'][1]}")
+        for row_index in manifest['rows'] + manifest['empty_rows']:
+            if row_index % manifest['shard_count'] != shard - 1:
+                misplaced_rows.append(row_index)
+            if row_index in row_owners:
+                duplicate_rows.append(row_index)
+            row_owners[row_index] = shard
+        merged_files.extend({'shard': shard, 'folder': str(manifest_path.parent), 'file': file_name} for file_name in manifest['files'])
+    missing_shards = [shard for shard in range(1, shard_count + 1) if shard not in shards_seen]
+    if missing_shards:
+        problems.append(f"missing manifests of shards {format_ranges(missing_shards)} of {shard_count}")
+    missing_rows = [i for i in range(first['last_row_index'] + 1) if i not in row_owners]
+    for label, row_indexes in (('not covered by any shard', missing_rows), ('covered more than once', duplicate_rows),
+                               ('assigned to the wrong shard', misplaced_rows)):
+        if row_indexes:
+            problems.append(f"patient indexes {format_ranges(row_indexes)} {label}")
+    if problems:
+        raise ValueError("ERROR: - Merging Shards - " + "; ".join(problems))
+    generated_rows = sorted(row_index for _, manifest in manifests for row_index in manifest['rows'])
+    return {
+        'input_file': first['input_file'],
+        'input_sha256': first['input_sha256'],
+        'shard_count': shard_count,
+        'last_row_index': first['last_row_index'],
+        'rows': generated_rows,
+        'files': merged_files
+    }
+
+#Compact "0-4, 9, 12-13" rendering of a list of indexes, cut short after max_ranges ranges
+def format_ranges(indexes, max_ranges = 20):
+    ranges = []
+    for index in sorted(set(indexes)):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    rendered = ", ".join(str(start) if start == end else f"{start}-{end}" for start, end in ranges[:max_ranges])
+    if len(ranges) > max_ranges:
+        rendered += f" and {len(ranges) - max_ranges} more ranges ({len(set(indexes))} in total)"
+    return rendered
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the manifests of a cohort generated in shards and verify every patient row was covered once.")
+    parser.add_argument('--manifests', type=str, nargs='+', help="Shard manifest files, or output folders containing them", required=True)
+    parser.add_argument('--output_file', type=str, help="Path to write the merged manifest", default="manifest.json")
+    args = parser.parse_args()
+    #A failed check is reported as a message and a non-zero exit status, not a traceback
+    try:
+        merged = merge_manifests(args.manifests)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    Path(args.output_file).write_bytes(orjson.dumps(merged, option=orjson.OPT_INDENT_2))
+    print(f"Merged {merged['shard_count']} shards: {len(merged['rows'])} patients in {len(merged['files'])} files, every patient index from 0 to {merged['last_row_index']} covered once")
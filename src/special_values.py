@@ -1,8 +1,19 @@
 
 import conversion
 
+import orjson
 from abc import ABC, abstractmethod
 
+# Frozen json structure shared by every bundle. The definition is held as encoded bytes, so it can not be mutated,
+# and each call to instantiate() decodes a brand new structure. Decoding with orjson is a much cheaper structural
+# clone than copy.deepcopy, which keeps per-bundle instances safe to build concurrently, cache and keep in memory
+class JsonTemplate:
+    def __init__(self, definition):
+        self.encoded = orjson.dumps(definition)
+
+    def instantiate(self):
+        return orjson.loads(self.encoded)
+
 # Define an abstract base class
 class AbstractCustomValueHandler(ABC):
     
@@ -12,52 +23,52 @@ class AbstractCustomValueHandler(ABC):
     
 class PatientRaceExtensionValueHandler(AbstractCustomValueHandler):
     omb_categories = {
-      "american indian or alaska native" : {
+      "american indian or alaska native" : JsonTemplate({
         "url" : "ombCategory",
         "valueCoding" : {
           "system" : "urn:oid:2.16.840.1.113883.6.238",
           "code" : "1002-5",
           "display" : "American Indian or Alaska Native"
           }
-      },
-      "asian" : {
+      }),
+      "asian" : JsonTemplate({
         "url" : "ombCategory",
         "valueCoding" : {
           "system" : "urn:oid:2.16.840.1.113883.6.238",
           "code" : "2028-9",
           "display" : "Asian"
           }
-      },
-      "black or african american" : {
+      }),
+      "black or african american" : JsonTemplate({
         "url" : "ombCategory",
         "valueCoding" : {
           "system" : "urn:oid:2.16.840.1.113883.6.238",
           "code" : "2054-5",
           "display" : "Black or African American"
           }
-      },
-      "native hawaiian or other pacific islander" : {
+      }),
+      "native hawaiian or other pacific islander" : JsonTemplate({
         "url" : "ombCategory",
         "valueCoding" : {
           "system" : "urn:oid:2.16.840.1.113883.6.238",
           "code" : "2054-5",
           "display" : "Native Hawaiian or Other Pacific Islander"
           }  
-      },
-      "white" : {
+      }),
+      "white" : JsonTemplate({
         "url" : "ombCategory",
         "valueCoding" : {
           "system" : "urn:oid:2.16.840.1.113883.6.238",
           "code" : "2106-3",
           "display" : "White"
         }
-      }
+      })
     }
     
-    initial_race_json = {
+    initial_race_json = JsonTemplate({
       "extension" : [
         {
-          "$ombCategory"
+          "url" : "$ombCategory"
         },
         {
           "url" : "text",
@@ -65,60 +76,61 @@ class PatientRaceExtensionValueHandler(AbstractCustomValueHandler):
         }
       ],
       "url" : "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race"
-    }
+    })
     #Create an ombcategory and detailed section of race extension
     def assign_value(self, json_path, resource_definition, entity_definition, final_struct, key, value):
-        #Retrieve the race extension if it exists; make it if it does not.
-        if 'extension' not in final_struct:
-            final_struct['extension'] = []
-        race_block = utilFindExtensionWithURL(final_struct['extension'], 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race')
-        if race_block is None:
-            race_block = self.initial_race_json
-            final_struct['extension'].append(race_block)
         for race_key, race_structure in self.omb_categories.items():
             if value.strip().lower() == race_key:
+                #Retrieve the race extension if it exists; make it if it does not.
+                if 'extension' not in final_struct:
+                    final_struct['extension'] = []
+                race_block = utilFindExtensionWithURL(final_struct['extension'], 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race')
+                if race_block is None:
+                    race_block = self.initial_race_json.instantiate()
+                    final_struct['extension'].append(race_block)
                 # Replace $ombCategory in the extension list
                 for i, item in enumerate(race_block["extension"]):
-                    if isinstance(item, set) and "$ombCategory" in item:
-                        # Replace the set with the new structure
-                        race_block["extension"][i] = race_structure
-                    elif isinstance(item, dict) and item.get("valueString") == "$text":
+                    if item.get("url") == "$ombCategory":
+                        # Replace the placeholder with the new structure
+                        race_block["extension"][i] = race_structure.instantiate()
+                    elif item.get("valueString") == "$text":
                         item['valueString'] = race_key
                 return final_struct
-        pass
+        print(f"WARNING: Full jsonpath: {json_path} - Race value '{value}' is not one of {', '.join(self.omb_categories)}; no race extension was created")
+        return final_struct
 
 class PatientEthnicityExtensionValueHandler(AbstractCustomValueHandler):
     omb_categories = {
-      "Hispanic or Latino" : {
+      "Hispanic or Latino" : JsonTemplate({
         "url" : "ombCategory",
         "valueCoding" : {
           "system" : "urn:oid:2.16.840.1.113883.6.238",
           "code" : "2135-2",
           "display" : "Hispanic or Latino"
           }
-      },
-      "Non Hispanic or Latino" : {
+      }),
+      "Non Hispanic or Latino" : JsonTemplate({
         "url" : "ombCategory",
         "valueCoding" : {
           "system" : "urn:oid:2.16.840.1.113883.6.238",
           "code" : "2186-5",
           "display" : "Not Hispanic or Latino"
           }
-      },
-      "Not Hispanic or Latino" : {
+      }),
+      "Not Hispanic or Latino" : JsonTemplate({
         "url" : "ombCategory",
         "valueCoding" : {
           "system" : "urn:oid:2.16.840.1.113883.6.238",
           "code" : "2186-5",
           "display" : "Not Hispanic or Latino"
           }
-      }
+      })
     }
     
-    initial_ethnicity_json = {
+    initial_ethnicity_json = JsonTemplate({
       "extension" : [
         {
-          "$ombCategory"
+          "url" : "$ombCategory"
         },
         {
           "url" : "text",
@@ -126,47 +138,48 @@ class PatientEthnicityExtensionValueHandler(AbstractCustomValueHandler):
         }
       ],
       "url" : "http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity"
-    }
+    })
     #Create an ombcategory and detailed section of ethnicitiy extension
     def assign_value(self, json_path, resource_definition, entity_definition, final_struct, key, value):
-        #Retrieve the ethncitiy extension if it exists; make it if it does not.
-        if 'extension' not in final_struct:
-            final_struct['extension'] = []
-        ethnicity_block = utilFindExtensionWithURL(final_struct['extension'], 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity')
-        if ethnicity_block is None:
-            ethnicity_block = self.initial_ethnicity_json
-            final_struct['extension'].append(ethnicity_block)
         for race_key, race_structure in self.omb_categories.items():
             if value.strip().lower() == race_key.strip().lower():
+                #Retrieve the ethncitiy extension if it exists; make it if it does not.
+                if 'extension' not in final_struct:
+                    final_struct['extension'] = []
+                ethnicity_block = utilFindExtensionWithURL(final_struct['extension'], 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity')
+                if ethnicity_block is None:
+                    ethnicity_block = self.initial_ethnicity_json.instantiate()
+                    final_struct['extension'].append(ethnicity_block)
                 # Replace $ombCategory in the extension list
                 for i, item in enumerate(ethnicity_block["extension"]):
-                    if isinstance(item, set) and "$ombCategory" in item:
-                        # Replace the set with the new structure
-                        ethnicity_block["extension"][i] = race_structure
-                    elif isinstance(item, dict) and item.get("valueString") == "$text":
+                    if item.get("url") == "$ombCategory":
+                        # Replace the placeholder with the new structure
+                        ethnicity_block["extension"][i] = race_structure.instantiate()
+                    elif item.get("valueString") == "$text":
                         item['valueString'] = race_key
                 return final_struct
-        pass
+        print(f"WARNING: Full jsonpath: {json_path} - Ethnicity value '{value}' is not one of {', '.join(self.omb_categories)}; no ethnicity extension was created")
+        return final_struct
       
 class PatientBirthSexExtensionValueHandler(AbstractCustomValueHandler):
-    birth_sex_block = {
+    birth_sex_block = JsonTemplate({
       "url" : "http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex",
       "valueCode" : "$value"
-    }
+    })
     #Assigna birthsex extension
     def assign_value(self, json_path, resource_definition, entity_definition, final_struct, key, value):
         #Retrieve the birthsex extension if it exists; make it if it does not.
         if 'extension' not in final_struct:
             final_struct['extension'] = []
-        birthsex_block = utilFindExtensionWithURL(final_struct['extension'], 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity')
+        birthsex_block = utilFindExtensionWithURL(final_struct['extension'], 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex')
         if birthsex_block is None:
-            birthsex_block = self.birth_sex_block
+            birthsex_block = self.birth_sex_block.instantiate()
             birthsex_block['valueCode'] = value
             final_struct['extension'].append(birthsex_block)
         pass
       
 class PatientMRNIdentifierValueHandler(AbstractCustomValueHandler):
-    patient_mrn_block = {
+    patient_mrn_block = JsonTemplate({
       "use" : "usual",
       "type" : {
         "coding" : [
@@ -177,15 +190,12 @@ class PatientMRNIdentifierValueHandler(AbstractCustomValueHandler):
           }
         ],
         "text" : "Medical Record Number"
-      },
-      "system" : "$system",
-      "value" : "$value"
-    }
+      }
+    })
     #Assign a MRN identifier
     def assign_value(self, json_path, resource_definition, entity_definition, final_struct, key, value):
         #Retrieve the MRN identifier if it exists; make it if it does not.
-        target_identifier = self.patient_mrn_block
-        new_identifier = True
+        target_identifier = None
         if 'identifier' not in final_struct:
           final_struct['identifier'] = []
         for identifier in final_struct['identifier']:
@@ -193,14 +203,14 @@ class PatientMRNIdentifierValueHandler(AbstractCustomValueHandler):
             for coding in identifier['type']['coding']:
               if coding['code'] == 'MR':
                 target_identifier = identifier
-                new_identifier = False
-        if new_identifier:
+        if target_identifier is None:
+          target_identifier = self.patient_mrn_block.instantiate()
           final_struct['identifier'].append(target_identifier)
         target_identifier[key] = value
         pass
       
 class PatientSSNIdentifierValueHandler(AbstractCustomValueHandler):
-    patient_mrn_block = {
+    patient_mrn_block = JsonTemplate({
       "use" : "usual",
       "type" : {
         "coding" : [
@@ -210,15 +220,12 @@ class PatientSSNIdentifierValueHandler(AbstractCustomValueHandler):
           }
         ],
         "text" : "Social Security Number"
-      },
-      "system" : "$system",
-      "value" : "$value"
-    }
+      }
+    })
     #Assign a MRN identifier
     def assign_value(self, json_path, resource_definition, entity_definition, final_struct, key, value):
         #Retrieve the MRN identifier if it exists; make it if it does not.
-        target_identifier = self.patient_mrn_block
-        new_identifier = True
+        target_identifier = None
         if 'identifier' not in final_struct:
           final_struct['identifier'] = []
         for identifier in final_struct['identifier']:
@@ -226,17 +233,17 @@ class PatientSSNIdentifierValueHandler(AbstractCustomValueHandler):
             for coding in identifier['type']['coding']:
               if coding['code'] == 'SS':
                 target_identifier = identifier
-                new_identifier = False
-        if new_identifier:
+        if target_identifier is None:
+          target_identifier = self.patient_mrn_block.instantiate()
           final_struct['identifier'].append(target_identifier)
         target_identifier[key] = value
         pass
       
 class OrganizationIdentiferNPIValueHandler(AbstractCustomValueHandler):
-    npi_identifier_block = {
+    npi_identifier_block = JsonTemplate({
       "system" : "http://hl7.org.fhir/sid/us-npi",
       "value" : "$value"
-    }
+    })
     #Assigna birthsex extension
     def assign_value(self, json_path, resource_definition, entity_definition, final_struct, key, value):
         #Retrieve the birthsex extension if it exists; make it if it does not.
@@ -244,16 +251,16 @@ class OrganizationIdentiferNPIValueHandler(AbstractCustomValueHandler):
             final_struct['identifier'] = []
         identifier_block = next((entry for entry in final_struct['identifier'] if entry['system'] == "http://hl7.org.fhir/sid/us-npi"), None)
         if identifier_block is None:
-          identifier_block = self.npi_identifier_block
+          identifier_block = self.npi_identifier_block.instantiate()
           final_struct['identifier'].append(identifier_block)
         identifier_block['value'] = str(value)
         pass
       
 class OrganizationIdentiferCLIAValueHandler(AbstractCustomValueHandler):
-    clia_identifier_block = {
+    clia_identifier_block = JsonTemplate({
       "system" : "urn:oid:2.16.840.1.113883.4.7",
       "value" : "$value"
-    }
+    })
     #Assigna birthsex extension
     def assign_value(self, json_path, resource_definition, entity_definition, final_struct, key, value):
         #Retrieve the birthsex extension if it exists; make it if it does not.
@@ -261,16 +268,16 @@ class OrganizationIdentiferCLIAValueHandler(AbstractCustomValueHandler):
             final_struct['identifier'] = []
         identifier_block = next((entry for entry in final_struct['identifier'] if entry['system'] == "urn:oid:2.16.840.1.113883.4.7"), None)
         if identifier_block is None:
-          identifier_block = self.clia_identifier_block
+          identifier_block = self.clia_identifier_block.instantiate()
           final_struct['identifier'].append(identifier_block)
         identifier_block['value'] = str(value)
         pass
       
 class PractitionerIdentiferNPIValueHandler(AbstractCustomValueHandler):
-    npi_identifier_block = {
+    npi_identifier_block = JsonTemplate({
       "system" : "http://hl7.org.fhir/sid/us-npi",
       "value" : "$value"
-    }
+    })
     #Assigna birthsex extension
     def assign_value(self, json_path, resource_definition, entity_definition, final_struct, key, value):
         #Retrieve the birthsex extension if it exists; make it if it does not.
@@ -278,13 +285,13 @@ class PractitionerIdentiferNPIValueHandler(AbstractCustomValueHandler):
             final_struct['identifier'] = []
         identifier_block = next((entry for entry in final_struct['identifier'] if entry['system'] == "http://hl7.org.fhir/sid/us-npi"), None)
         if identifier_block is None:
-          identifier_block = self.npi_identifier_block
+          identifier_block = self.npi_identifier_block.instantiate()
           final_struct['identifier'].append(identifier_block)
         identifier_block['value'] = value
         pass
       
 class ObservationComponentHandler(AbstractCustomValueHandler):
-    pulse_oximetry_oxygen_flow_rate = {
+    pulse_oximetry_oxygen_flow_rate = JsonTemplate({
       "code" : {
         "coding" : [
           {
@@ -295,8 +302,8 @@ class ObservationComponentHandler(AbstractCustomValueHandler):
         ],
         "text" : "Inhaled oxygen flow rate"
       }
-    }
-    pulse_oximetry_oxygen_concentration = {
+    })
+    pulse_oximetry_oxygen_concentration = JsonTemplate({
       "code" : {
         "coding" : [
           {
@@ -307,7 +314,7 @@ class ObservationComponentHandler(AbstractCustomValueHandler):
         ],
         "text" : "Inhaled oxygen concentration"
       }
-    }
+    })
     #Find the appropriate component for the observaiton; then call build_structure again to continue the drill down
     def assign_value(self, json_path, resource_definition, entity_definition, final_struct, key, value):
         #Check to make sure the component part exists
@@ -322,12 +329,14 @@ class ObservationComponentHandler(AbstractCustomValueHandler):
         
         target_component = None
         if qualifier_condition[0] == 'code' and qualifier_condition[1] == '3151-8':
-          target_component = findComponentWithCoding(components, '3151-8') or self.pulse_oximetry_oxygen_flow_rate
-          if target_component is self.pulse_oximetry_oxygen_flow_rate:
+          target_component = findComponentWithCoding(components, '3151-8')
+          if target_component is None:
+            target_component = self.pulse_oximetry_oxygen_flow_rate.instantiate()
             components.append(target_component)
         if qualifier_condition[0] == 'code' and qualifier_condition[1] == '3150-0':
-          target_component = findComponentWithCoding(components, '3150-0') or self.pulse_oximetry_oxygen_concentration
-          if target_component is self.pulse_oximetry_oxygen_concentration:
+          target_component = findComponentWithCoding(components, '3150-0')
+          if target_component is None:
+            target_component = self.pulse_oximetry_oxygen_concentration.instantiate()
             components.append(target_component)
         #Recurse back down into 
         return conversion.build_structure(target_component, '.'.join(parts[2:]), resource_definition, entity_definition, parts[2:], value, parts[:2])
@@ -337,7 +346,7 @@ def utilFindExtensionWithURL(extension_block, url):
     for extension in extension_block:
         if "url" in extension and extension['url'] == url:
             return extension
-        return None
+    return None
 
 def findComponentWithCoding(components, code):
   return next((component for component in components if any(coding['code'] == code for coding in component['code']['coding'])), None)
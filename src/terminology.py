@@ -0,0 +1,190 @@
+import re
+from contextlib import contextmanager
+from pathlib import Path
+import orjson
+
+#Index the codings of codeableconcept and coding columns are checked against; None when no terminology was loaded,
+#in which case codings are left exactly as they are in the workbook
+active_index = None
+
+#Make index the active index for the duration of a with block, restoring the previous one afterwards even on errors, so
+#a run checking codings leaves later conversions in the same process unchecked
+@contextmanager
+def activated(index):
+    global active_index
+    previous_index = active_index
+    active_index = index
+    try:
+        yield index
+    finally:
+        active_index = previous_index
+
+# In memory index of local ValueSet and CodeSystem files. Concepts are keyed by (system, code) and value sets by a
+# normalized name, so a check is a few dict lookups. Every distinct (value set, system, code) is checked once per run;
+# later rows with the same value reuse the result and do not repeat its warning.
+class TerminologyIndex:
+    def __init__(self):
+        #Every (system, code) loaded, with or without a display
+        self.codes = set()
+        #(system, code) -> display, only used to fill in missing displays
+        self.displays = {}
+        #Systems loaded as complete code systems; only codes of these systems are checked for existence
+        self.complete_systems = set()
+        #ValueSet name -> {'codes': set of (system, code), 'systems': systems included whole}
+        self.value_sets = {}
+        #(valueset, system, code) -> (display, problems)
+        self.checked = {}
+
+    #Load a ValueSet/CodeSystem json file, a Bundle of them, a csv file or a folder of those files
+    def load(self, path):
+        path = Path(path)
+        if path.is_dir():
+            for file_path in sorted(path.rglob('*')):
+                if file_path.suffix.lower() in ('.json', '.csv'):
+                    self.load(file_path)
+        elif path.suffix.lower() == '.csv':
+            self.load_csv(path)
+        elif path.suffix.lower() == '.json':
+            self.load_resource(orjson.loads(path.read_bytes()), path.name)
+        else:
+            raise ValueError(f"ERROR: - Terminology - {path} - expected a folder, a .json or a .csv file")
+        return self
+
+    def load_resource(self, resource, source):
+        resource_type = resource.get('resourceType') if isinstance(resource, dict) else None
+        if resource_type == 'Bundle':
+            for entry in resource.get('entry', []):
+                self.load_resource(entry.get('resource'), source)
+        elif resource_type == 'CodeSystem':
+            self.load_code_system(resource)
+        elif resource_type == 'ValueSet':
+            self.load_value_set(resource)
+        else:
+            print(f"WARNING: - Terminology - {source} - {resource_type} is not a ValueSet or CodeSystem and is ignored")
+
+    def load_code_system(self, code_system):
+        system = code_system.get('url')
+        if not system:
+            print(f"WARNING: - Terminology - CodeSystem/{code_system.get('id')} - has no url and is ignored")
+            return
+        #Fragments and examples do not list every code, so codes missing from them are not reported
+        if code_system.get('content', 'complete') == 'complete':
+            self.complete_systems.add(system)
+        self.add_concepts(system, code_system.get('concept', []), None)
+        if code_system.get('valueSet'):
+            self.get_value_set(code_system['valueSet'])['systems'].add(system)
+
+    #CodeSystem concepts nest their child concepts under 'concept'
+    def add_concepts(self, system, concepts, value_set):
+        for concept in concepts:
+            if concept.get('code'):
+                self.add_code(system, concept['code'], concept.get('display'), value_set)
+            self.add_concepts(system, concept.get('concept', []), value_set)
+
+    def load_value_set(self, value_set_resource):
+        value_set = self.get_value_set(value_set_resource.get('url') or value_set_resource.get('id') or '')
+        if value_set_resource.get('id'):
+            self.value_sets.setdefault(value_set_name(value_set_resource['id']), value_set)
+        for include in value_set_resource.get('compose', {}).get('include', []):
+            if include.get('concept'):
+                for concept in include['concept']:
+                    self.add_code(include.get('system'), concept.get('code'), concept.get('display'), value_set)
+            elif include.get('system'):
+                value_set['systems'].add(include['system'])
+        #Expansions nest contained codes under 'contains'
+        contains = list(value_set_resource.get('expansion', {}).get('contains', []))
+        while contains:
+            concept = contains.pop()
+            if concept.get('code'):
+                self.add_code(concept.get('system'), concept['code'], concept.get('display'), value_set)
+            contains.extend(concept.get('contains', []))
+
+    #Csv files have a header row with system, code and display columns, and optionally a valueset column.
+    #Rows without a valueset are the concepts of a complete code system
+    def load_csv(self, path):
+        import csv
+        with open(path, newline='', encoding='utf-8-sig') as csv_file:
+            reader = csv.DictReader(csv_file)
+            columns = {name.strip().lower(): name for name in reader.fieldnames or []}
+            if 'system' not in columns or 'code' not in columns:
+                raise ValueError(f"ERROR: - Terminology - {path} - csv files need a header row with at least 'system' and 'code' columns")
+            for row in reader:
+                system = (row[columns['system']] or '').strip()
+                code = (row[columns['code']] or '').strip()
+                if not system or not code:
+                    continue
+                display = (row[columns['display']] or '').strip() if 'display' in columns else ''
+                valueset = (row[columns['valueset']] or '').strip() if 'valueset' in columns else ''
+                if valueset:
+                    self.add_code(system, code, display, self.get_value_set(valueset))
+                else:
+                    self.complete_systems.add(system)
+                    self.add_code(system, code, display, None)
+
+    def add_code(self, system, code, display, value_set):
+        if not system or not code:
+            return
+        self.codes.add((system, code))
+        if display and (system, code) not in self.displays:
+            self.displays[(system, code)] = display
+        if value_set is not None:
+            value_set['codes'].add((system, code))
+
+    def get_value_set(self, reference):
+        return self.value_sets.setdefault(value_set_name(reference), {'codes': set(), 'systems': set()})
+
+    #Check codings built from a cell against the value set named in the column's ValueSet row, filling in
+    #missing displays. Problems are printed the first time a distinct value is seen
+    def check_codings(self, codings, valueset = None):
+        valueset = value_set_name(valueset) if valueset else None
+        for coding in codings:
+            system = coding.get('system')
+            code = coding.get('code')
+            if not system or not code:
+                continue
+            result = self.checked.get((valueset, system, code))
+            if result is None:
+                result = self.check_code(valueset, system, code)
+                self.checked[(valueset, system, code)] = result
+                for problem in result[1]:
+                    print(f"WARNING: - Terminology - {system}|{code} - {problem}")
+            if result[0] and not coding.get('display'):
+                coding['display'] = result[0]
+        return codings
+
+    def check_code(self, valueset, system, code):
+        problems = []
+        if system in self.complete_systems and (system, code) not in self.codes:
+            problems.append(f"code not found in CodeSystem {system}")
+        value_set = self.value_sets.get(valueset) if valueset else None
+        if value_set is not None and (system, code) not in value_set['codes'] and system not in value_set['systems']:
+            problems.append(f"code not in ValueSet {valueset}")
+        return (self.displays.get((system, code)), problems)
+
+    #Summary of the distinct values checked this run
+    def report(self):
+        problem_count = sum(1 for _, problems in self.checked.values() if problems)
+        return f"Terminology: {len(self.checked)} distinct codes checked, {problem_count} with problems"
+
+#Reduce a ValueSet url, canonical url, id or the web page it is published on to a comparable name:
+#'https://hl7.org/fhir/R4/valueset-event-status.html' and 'http://hl7.org/fhir/ValueSet/event-status' both give 'event-status'
+def value_set_name(reference):
+    segments = [segment for segment in re.split(r'[/|]', reference.strip().lower()) if segment]
+    if not segments:
+        return ''
+    name = re.sub(r'\.(html|json|xml)$', '', segments[-1])
+    #v3 value sets are published as .../v3/ActEncounterCode/vs.html
+    if name == 'vs' and len(segments) > 1:
+        name = segments[-2]
+    #A version such as '|4.0.1' follows the name of a canonical url
+    if re.fullmatch(r'[\d.]+', name) and len(segments) > 1 and '|' in reference:
+        name = segments[-2]
+    return re.sub(r'^(valueset-|v3-)', '', name)
+
+#Load every path given into one index
+def load_terminology(paths):
+    index = TerminologyIndex()
+    for path in paths:
+        index.load(path)
+    print(f"Loaded terminology: {len(index.codes)} concepts, {len(index.value_sets)} value sets")
+    return index
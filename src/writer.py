@@ -0,0 +1,247 @@
+import os
+import queue
+import threading
+import time
+
+# Writes files on background threads so building the next bundle overlaps with writing the previous ones.
+# The queue is bounded: submit() blocks once max_pending files are waiting, which keeps memory bounded when
+# the disk is slower than conversion. Each thread drains up to batch_size files at a time. max_pending_bytes additionally
+# bounds the total size of the files waiting, for when a few bundles are very large. With compress, every file is
+# compressed on the writer thread that writes it, so compression runs on as many threads as writing does.
+class BackgroundWriter:
+    def __init__(self, threads = 1, max_pending = 64, batch_size = 16, fsync = False, max_pending_bytes = None, compress = None):
+        if threads < 1:
+            raise ValueError(f"ERROR: - Background Writer - at least one writer thread is required, got {threads}")
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.compress = compress
+        self.written_paths = []
+        self.errors = []
+        self.lock = threading.Lock()
+        #Seconds the writer threads spent compressing, writing and syncing files, summed over the threads
+        self.busy_seconds = 0.0
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self.pending_changed = threading.Condition(self.lock)
+        self.threads = [threading.Thread(target=self.run, name=f"bundle-writer-{n}", daemon=True) for n in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+        return False
+
+    #Queue bytes to be written to file_path; blocks while the queue is full
+    def submit(self, file_path, json_bytes):
+        self.raise_errors()
+        if self.max_pending_bytes is not None:
+            with self.pending_changed:
+                #A file larger than the limit on its own still goes through once nothing else is pending
+                while self.pending_bytes > 0 and self.pending_bytes + len(json_bytes) > self.max_pending_bytes and not self.errors:
+                    self.pending_changed.wait()
+                self.pending_bytes += len(json_bytes)
+        self.queue.put((file_path, json_bytes))
+
+    #Block until every file submitted so far is written
+    def wait_until_written(self):
+        self.queue.join()
+        self.raise_errors()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            #A batch never reaches past a stop marker, so each thread gets exactly one
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is None:
+                    self.queue.task_done()
+                    return
+                try:
+                    if not self.errors:
+                        self.write(*item)
+                finally:
+                    #Released even when the write failed, or submit() and close() would wait forever
+                    if self.max_pending_bytes is not None:
+                        with self.pending_changed:
+                            self.pending_bytes -= len(item[1])
+                            self.pending_changed.notify_all()
+                    self.queue.task_done()
+
+    def write(self, file_path, json_bytes):
+        start = time.perf_counter()
+        try:
+            if self.compress is not None:
+                json_bytes = self.compress(json_bytes)
+            with open(file_path, 'wb') as output_file:
+                output_file.write(json_bytes)
+            if self.fsync:
+                with self.lock:
+                    self.written_paths.append(file_path)
+        #Any failure, compression included, is kept and raised on the submitting thread
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+        finally:
+            with self.lock:
+                self.busy_seconds += time.perf_counter() - start
+
+    def raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    #Wait for every queued file to be written, then flush them to disk in one pass when fsync was requested
+    def close(self, raise_errors = True):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.fsync and not self.errors:
+            start = time.perf_counter()
+            sync_files(self.written_paths)
+            self.busy_seconds += time.perf_counter() - start
+        if raise_errors:
+            self.raise_errors()
+
+# Writes bundles as the lines of a single ndjson file. Lines are gathered into chunks of about chunk_bytes, which one
+# background thread writes in the order they were submitted while the next bundles are built, so the file reads back as
+# one stream in submission order. With compress, every chunk becomes an independent gzip member or zstd frame, compressed
+# on a pool of threads first. threads is the size of that pool; the file itself is always written by a single thread.
+# Errors on the background threads are raised on the submitting thread, as with BackgroundWriter.
+class StreamWriter:
+    def __init__(self, file_path, threads = 1, chunk_bytes = 1 << 20, fsync = False, max_pending_bytes = None, compress = None):
+        if threads < 1:
+            raise ValueError(f"ERROR: - Stream Writer - at least one writer thread is required, got {threads}")
+        self.file_path = file_path
+        self.chunk_bytes = chunk_bytes
+        self.fsync = fsync
+        self.compress = compress
+        #Chunks waiting to be written, compressed or not yet; enough to keep every thread busy, and within max_pending_bytes
+        self.max_pending_chunks = 2 * threads
+        if max_pending_bytes is not None:
+            self.max_pending_chunks = max(1, min(self.max_pending_chunks, max_pending_bytes // chunk_bytes))
+        #Bytes of each chunk in order, or the future compressing them; submit() blocks once the queue is full
+        self.pending = queue.Queue(maxsize=self.max_pending_chunks)
+        self.chunk = []
+        self.chunk_size = 0
+        self.errors = []
+        #Set when closing after a failure, so that the chunks still queued are dropped instead of written
+        self.discard = False
+        #Seconds spent compressing, writing and syncing chunks, summed over the threads
+        self.busy_seconds = 0.0
+        self.lock = threading.Lock()
+        self.executor = None
+        if compress is not None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="bundle-compressor")
+        self.output_file = open(file_path, 'wb')
+        self.thread = threading.Thread(target=self.run, name="bundle-stream-writer", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(write_pending=exc_type is None)
+        return False
+
+    #Add json_bytes, which must not contain a line break, as the next line
+    def submit(self, json_bytes):
+        self.chunk.append(json_bytes)
+        self.chunk.append(b'\n')
+        self.chunk_size += len(json_bytes) + 1
+        if self.chunk_size >= self.chunk_bytes:
+            self.end_chunk()
+
+    def end_chunk(self):
+        self.raise_errors()
+        if not self.chunk:
+            return
+        data = b''.join(self.chunk)
+        self.chunk = []
+        self.chunk_size = 0
+        self.pending.put(self.executor.submit(self.compress_chunk, data) if self.executor is not None else data)
+
+    def compress_chunk(self, data):
+        start = time.perf_counter()
+        try:
+            return self.compress(data)
+        finally:
+            with self.lock:
+                self.busy_seconds += time.perf_counter() - start
+
+    def run(self):
+        while True:
+            chunk = self.pending.get()
+            try:
+                if chunk is None:
+                    return
+                if not self.errors and not self.discard:
+                    self.write(chunk)
+            finally:
+                self.pending.task_done()
+
+    def write(self, chunk):
+        try:
+            chunk = chunk.result() if self.executor is not None else chunk
+            start = time.perf_counter()
+            self.output_file.write(chunk)
+            with self.lock:
+                self.busy_seconds += time.perf_counter() - start
+        #Any failure, compression included, is kept and raised on the submitting thread
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+
+    def raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    #Block until every line submitted so far is written; the lines gathered so far become a chunk of their own
+    def wait_until_written(self):
+        self.end_chunk()
+        self.pending.join()
+        self.raise_errors()
+
+    def close(self, write_pending = True):
+        try:
+            if write_pending:
+                self.end_chunk()
+        finally:
+            self.discard = not write_pending
+            self.pending.put(None)
+            self.thread.join()
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+            self.output_file.close()
+        if write_pending:
+            self.raise_errors()
+        if self.fsync and write_pending:
+            start = time.perf_counter()
+            sync_files([self.file_path])
+            self.busy_seconds += time.perf_counter() - start
+
+def sync_files(paths):
+    folders = set()
+    for path in paths:
+        file_descriptor = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(file_descriptor)
+        finally:
+            os.close(file_descriptor)
+        folders.add(os.path.dirname(os.path.abspath(path)))
+    #Directory entries of new files are only durable once their folder is synced (not supported on Windows)
+    if os.name != 'nt':
+        for folder in folders:
+            file_descriptor = os.open(folder, os.O_RDONLY)
+            try:
+                os.fsync(file_descriptor)
+            finally:
+                os.close(file_descriptor)